@@ -0,0 +1,92 @@
+"""
+Check that an API search over more than ANN_THRESHOLD critiques switches its
+warm index to approximate search, as reported by `/stats`.
+
+    python -m benchmarks.ann
+
+Runs in process on the in-memory database, which caps reads at PostgREST's
+`max_rows` like a deployment, so a search that read the environment in one
+request would index only the first rows and never cross the threshold. Exits
+non-zero when the index is not approximate or holds fewer rows than seeded.
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+from contextlib import AsyncExitStack
+
+from benchmarks.load import LOCAL_KEY, LOCAL_TEAM_NAME, open_client
+
+ENVIRONMENT_NAME = "ann"
+
+
+async def check(rows: int | None, seed: int) -> bool:
+    params = {"team_name": LOCAL_TEAM_NAME, "environment_name": ENVIRONMENT_NAME}
+    headers = {"x-critino-key": LOCAL_KEY, "x-openrouter-api-key": ""}
+
+    async with AsyncExitStack() as stack:
+        client = await open_client(stack, None, timeout=600)
+        # `open_client` imports `src` once its settings are in the environment
+        import src
+        from benchmarks.corpus import CorpusGenerator
+        from src.lib import few_shot
+
+        size = rows if rows is not None else few_shot.ANN_THRESHOLD + 1
+        generator = CorpusGenerator(seed)
+        critiques = generator.critiques(size)
+        src.app.state.supabase.seed(
+            {
+                "environments": [
+                    {"team_name": LOCAL_TEAM_NAME, "name": ENVIRONMENT_NAME}
+                ],
+                "critiques": [
+                    {
+                        "id": id,
+                        **params,
+                        "response": "",
+                        **critique.model_dump(),
+                    }
+                    for id, critique in critiques.items()
+                ],
+            }
+        )
+
+        (query,) = generator.queries(critiques, 1)
+        response = await client.get(
+            "/critiques", params={**params, "query": query, "k": 4}, headers=headers
+        )
+        response.raise_for_status()
+        response = await client.get("/stats", params=params, headers=headers)
+        response.raise_for_status()
+
+    (stats,) = [
+        index
+        for index in response.json()["indexes"]
+        if index["environment_name"] == ENVIRONMENT_NAME
+    ]
+    print(
+        f"{size} critiques, threshold {few_shot.ANN_THRESHOLD}: index of"
+        f" {stats['rows']} rows, approximate {stats['approximate']}",
+        file=sys.stderr,
+    )
+    return stats["rows"] == size and stats["approximate"] == (
+        size >= few_shot.ANN_THRESHOLD
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rows", type=int, help="Critiques to seed, ANN_THRESHOLD + 1 by default."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, force=True)
+    sys.exit(0 if asyncio.run(check(args.rows, args.seed)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import numpy as np
+
+from src.lib.few_shot import StrippedCritique
+
+SYLLABLES = [
+    *"ba be bi bo bu da de di do du ka ke ki ko ku la le li lo lu".split(),
+    *"ma me mi mo mu na ne ni no nu ra re ri ro ru sa se si so su".split(),
+    *"ta te ti to tu va ve vi vo vu za ze zi zo zu".split(),
+]
+
+# (minimum, maximum) words per field, roughly the shape of real critiques
+FIELD_LENGTHS = {
+    "query": (6, 20),
+    "context": (30, 120),
+    "situation": (10, 30),
+    "optimal": (20, 80),
+    "instructions": (5, 30),
+}
+
+
+def vocabulary(size: int, rng: np.random.Generator) -> np.ndarray:
+    words: set[str] = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES, rng.integers(2, 5))))
+    return np.array(sorted(words))
+
+
+class CorpusGenerator:
+    """
+    Deterministic synthetic critiques. Words are drawn from a Zipf-like
+    distribution over a made-up vocabulary, so a few words are common and
+    most are rare, as in natural text and as BM25's idf expects.
+    """
+
+    def __init__(self, seed: int = 0, vocabulary_size: int = 5000):
+        self.rng = np.random.default_rng(seed)
+        self.words = vocabulary(vocabulary_size, self.rng)
+        weights = 1 / np.arange(1, vocabulary_size + 1) ** 1.1
+        self.probabilities = weights / weights.sum()
+
+    def texts(self, count: int, lengths: tuple[int, int]) -> list[str]:
+        sizes = self.rng.integers(lengths[0], lengths[1] + 1, count)
+        words = self.words[
+            self.rng.choice(len(self.words), int(sizes.sum()), p=self.probabilities)
+        ]
+        ends = np.cumsum(sizes)
+        return [" ".join(words[end - size : end]) for size, end in zip(sizes, ends)]
+
+    def critiques(self, count: int) -> dict[str, StrippedCritique]:
+        fields = {
+            field: self.texts(count, lengths)
+            for field, lengths in FIELD_LENGTHS.items()
+        }
+        return {
+            f"critique-{i}": StrippedCritique(
+                **{field: texts[i] for field, texts in fields.items()}
+            )
+            for i in range(count)
+        }
+
+    def queries(self, critiques: dict[str, StrippedCritique], count: int) -> list[str]:
+        """
+        Queries paraphrasing random critiques: some of their words dropped
+        and a couple of unrelated ones added.
+        """
+        sources = list(critiques.values())
+        queries = []
+        for i in self.rng.integers(0, len(sources), count):
+            words = sources[i].query.split()
+            kept = [word for word in words if self.rng.random() > 0.3] or words[:1]
+            queries.append(" ".join([*kept, *self.texts(1, (2, 2))[0].split()]))
+        return queries
@@ -0,0 +1,72 @@
+import time
+import zlib
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from src.lib import few_shot
+from src.lib.bm25 import tokenize
+from src.lib.cache import EMBEDDING_CACHE_SIZE_LIMIT, CachedEmbeddings, open_cache
+
+
+@lru_cache(maxsize=1 << 16)
+def feature_hash(feature: str) -> int:
+    # crc32 rather than `hash`, which is salted per process
+    return zlib.crc32(feature.encode("utf-8"))
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Offline stand-in for the BGE model: words and word bigrams are hashed
+    into signed buckets of a unit vector. Texts sharing words score higher,
+    which is enough to exercise retrieval without torch or a download.
+    Time spent embedding is tracked in `seconds`, so it can be told apart
+    from indexing and search.
+    """
+
+    def __init__(self, dimensions: int = 384):
+        self.dimensions = dimensions
+        self.seconds = 0.0
+
+    def vector(self, text: str) -> np.ndarray:
+        tokens = tokenize(text)
+        hashes = np.fromiter(
+            (
+                feature_hash(feature)
+                for feature in [
+                    *tokens,
+                    *(f"{a} {b}" for a, b in zip(tokens, tokens[1:])),
+                ]
+            ),
+            dtype=np.int64,
+        )
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        np.add.at(vector, hashes % self.dimensions, np.where(hashes & (1 << 31), 1, -1))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        start = time.perf_counter()
+        vectors = [self.vector(text).tolist() for text in texts]
+        self.seconds += time.perf_counter() - start
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def use_hashing_embeddings() -> HashingEmbeddings:
+    """
+    Route `few_shot`'s document embeddings and its query batcher to a
+    `HashingEmbeddings`, behind the same disk cache as the real model.
+    """
+    model = HashingEmbeddings()
+    few_shot.embeddings = CachedEmbeddings(
+        model,
+        model_name="hashing",
+        cache=open_cache("embeddings", size_limit=EMBEDDING_CACHE_SIZE_LIMIT),
+    )
+    few_shot.batcher.embed_batch = few_shot.embeddings.embed_queries
+    few_shot.batcher.lookup = few_shot.embeddings.cached_query
+    return model
@@ -0,0 +1,362 @@
+"""
+Drive the API with a weighted mix of requests and report latency per route.
+
+    # In process, on the in-memory database with offline embeddings
+    python -m benchmarks.load --sizes 100,1000 --concurrency 16 --duration 30
+
+    # Against a deployment
+    python -m benchmarks.load --url https://api.example.com \
+        --team-name acme --key sp-critino-... --output load.json
+
+Each size gets its own environment, seeded with synthetic critiques through
+the bulk endpoint, then `--concurrency` clients send requests drawn from
+`--mix` for `--duration` seconds. In process, the app and the clients share
+one event loop and one CPU budget, so compare runs against each other rather
+than against a deployment.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Callable
+
+import httpx
+import numpy as np
+from pydantic import BaseModel
+
+from benchmarks.retrieval import Latency, Metadata, git_commit
+
+ROUTES = ["list", "search", "upsert", "bulk", "auth"]
+DEFAULT_MIX = "list=3,search=4,upsert=1,bulk=1,auth=1"
+DEFAULT_SIZES = [100, 1000, 10_000]
+# Critiques per request when seeding, and per bulk request of the mix
+SEED_BATCH_SIZE = 500
+BULK_SIZE = 20
+# Team and key created in the in-memory database
+LOCAL_TEAM_NAME = "load"
+LOCAL_KEY = "load-key"
+
+
+class RouteResult(BaseModel):
+    size: int
+    route: str
+    requests: int
+    errors: int
+    error_rate: float
+    throughput_rps: float
+    latency: Latency
+
+
+class LoadResults(BaseModel):
+    metadata: Metadata
+    target: str
+    concurrency: int
+    duration: float
+    mix: dict[str, float]
+    results: list[RouteResult]
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for pair in value.split(","):
+        route, weight = pair.split("=")
+        if route not in ROUTES:
+            raise ValueError(f"Unknown route: {route}")
+        mix[route] = float(weight)
+    return mix
+
+
+class Workload:
+    """The requests of the mix, against one environment."""
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        team_name: str,
+        key: str,
+        environment_name: str,
+        seed: int,
+    ):
+        from benchmarks.corpus import CorpusGenerator
+
+        self.client = client
+        self.team_name = team_name
+        self.environment_name = environment_name
+        self.headers = {"x-critino-key": key, "x-openrouter-api-key": ""}
+        self.generator = CorpusGenerator(seed)
+        self.random = random.Random(seed)
+        self.queries: list[str] = []
+        self.routes: dict[str, Callable[[], Awaitable[httpx.Response]]] = {
+            "list": self.list,
+            "search": self.search,
+            "upsert": self.upsert,
+            "bulk": self.bulk,
+            "auth": self.auth,
+        }
+
+    @property
+    def params(self) -> dict[str, Any]:
+        return {
+            "team_name": self.team_name,
+            "environment_name": self.environment_name,
+        }
+
+    def critiques(self, count: int) -> list[dict[str, Any]]:
+        return [
+            {
+                "id": f"load-{uuid.uuid4()}",
+                # NOT NULL, and the single upsert writes the null it is sent
+                "response": "",
+                **critique.model_dump(exclude={"situation"}),
+            }
+            for critique in self.generator.critiques(count).values()
+        ]
+
+    async def seed(self, size: int) -> None:
+        critiques = self.generator.critiques(size)
+        self.queries = self.generator.queries(critiques, 1000)
+        rows = [
+            {"id": id, "response": "", **critique.model_dump(exclude={"situation"})}
+            for id, critique in critiques.items()
+        ]
+        for start in range(0, len(rows), SEED_BATCH_SIZE):
+            response = await self.client.post(
+                "/critiques",
+                params=self.params,
+                json={"critiques": rows[start : start + SEED_BATCH_SIZE]},
+                headers=self.headers,
+            )
+            response.raise_for_status()
+
+    async def list(self) -> httpx.Response:
+        return await self.client.get(
+            "/critiques", params={**self.params, "limit": 100}, headers=self.headers
+        )
+
+    async def search(self) -> httpx.Response:
+        return await self.client.get(
+            "/critiques",
+            params={**self.params, "query": self.random.choice(self.queries), "k": 4},
+            headers=self.headers,
+        )
+
+    async def upsert(self) -> httpx.Response:
+        (critique,) = self.critiques(1)
+        id = critique.pop("id")
+        return await self.client.post(
+            f"/critiques/{id}", params=self.params, json=critique, headers=self.headers
+        )
+
+    async def bulk(self) -> httpx.Response:
+        return await self.client.post(
+            "/critiques",
+            params=self.params,
+            json={"critiques": self.critiques(BULK_SIZE)},
+            headers=self.headers,
+        )
+
+    async def auth(self) -> httpx.Response:
+        if self.random.random() < 0.5:
+            return await self.client.get(
+                f"/auth/team/{self.team_name}", headers=self.headers
+            )
+        parent_name, _, name = self.environment_name.rpartition("/")
+        return await self.client.get(
+            f"/auth/environment/{name}",
+            params={"team_name": self.team_name, "parent_name": parent_name or None},
+            headers=self.headers,
+        )
+
+
+async def run_load(
+    workload: Workload,
+    mix: dict[str, float],
+    concurrency: int,
+    duration: float,
+    warmup: int,
+) -> tuple[dict[str, list[tuple[float, bool]]], float]:
+    """
+    Closed loop: each of `concurrency` clients sends its next request as
+    soon as the previous one is answered. Returns (latency, ok) samples by
+    route and the seconds the run took.
+    """
+    routes = list(mix)
+    weights = list(mix.values())
+    samples: dict[str, list[tuple[float, bool]]] = {route: [] for route in routes}
+
+    for route in workload.random.choices(routes, weights, k=warmup):
+        await workload.routes[route]()
+
+    async def client() -> None:
+        while time.perf_counter() < deadline:
+            (route,) = workload.random.choices(routes, weights)
+            start = time.perf_counter()
+            try:
+                response = await workload.routes[route]()
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            samples[route].append((time.perf_counter() - start, ok))
+
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return samples, time.perf_counter() - start
+
+
+def summarize(
+    size: int, route: str, samples: list[tuple[float, bool]], elapsed: float
+) -> RouteResult:
+    latencies = 1000 * np.array([latency for latency, _ in samples] or [0.0])
+    errors = sum(not ok for _, ok in samples)
+    return RouteResult(
+        size=size,
+        route=route,
+        requests=len(samples),
+        errors=errors,
+        error_rate=errors / len(samples) if samples else 0,
+        throughput_rps=len(samples) / elapsed,
+        latency=Latency(
+            mean_ms=float(latencies.mean()),
+            p50_ms=float(np.percentile(latencies, 50)),
+            p95_ms=float(np.percentile(latencies, 95)),
+            p99_ms=float(np.percentile(latencies, 99)),
+        ),
+    )
+
+
+async def open_client(
+    stack: AsyncExitStack, url: str | None, timeout: float
+) -> httpx.AsyncClient:
+    if url is not None:
+        return await stack.enter_async_context(
+            httpx.AsyncClient(base_url=url, timeout=timeout)
+        )
+
+    # Settings are read on import
+    os.environ.setdefault("CRITINO_DB", "memory")
+    os.environ.setdefault("CRITINO_WARM_EMBEDDINGS", "false")
+    import src
+    from benchmarks.embeddings import use_hashing_embeddings
+    from src.interfaces.memory_db import MemoryClient
+    from src.lib import keys
+
+    use_hashing_embeddings()
+    await stack.enter_async_context(src.app.router.lifespan_context(src.app))
+    supabase = src.app.state.supabase
+    if isinstance(supabase, MemoryClient):
+        supabase.seed(
+            {"teams": [{"name": LOCAL_TEAM_NAME, "key": keys.encrypt_key(LOCAL_KEY)}]}
+        )
+    return await stack.enter_async_context(
+        httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=src.app),
+            base_url="http://critino",
+            timeout=timeout,
+        )
+    )
+
+
+async def main_async(args: argparse.Namespace, mix: dict[str, float]) -> LoadResults:
+    metadata = Metadata(
+        commit=git_commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        started_at=time.time(),
+    )
+    team_name = args.team_name or LOCAL_TEAM_NAME
+    key = args.key or LOCAL_KEY
+    run = uuid.uuid4().hex[:8]
+
+    results = []
+    async with AsyncExitStack() as stack:
+        client = await open_client(stack, args.url, args.timeout)
+        for size in [int(size) for size in args.sizes.split(",")]:
+            workload = Workload(
+                client, team_name, key, f"load-{run}/size-{size}", args.seed
+            )
+            print(f"{size:>7} seeding", file=sys.stderr)
+            await workload.seed(size)
+
+            samples, elapsed = await run_load(
+                workload, mix, args.concurrency, args.duration, args.warmup
+            )
+            for route, route_samples in samples.items():
+                result = summarize(size, route, route_samples, elapsed)
+                print(
+                    f"{size:>7} {route:<6} {result.requests:6} requests"
+                    f"  p50 {result.latency.p50_ms:8.2f} ms"
+                    f"  p95 {result.latency.p95_ms:8.2f} ms"
+                    f"  p99 {result.latency.p99_ms:8.2f} ms"
+                    f"  {result.throughput_rps:7.1f} req/s"
+                    f"  {100 * result.error_rate:5.1f}% errors",
+                    file=sys.stderr,
+                )
+                results.append(result)
+
+    return LoadResults(
+        metadata=metadata,
+        target=args.url or "asgi",
+        concurrency=args.concurrency,
+        duration=args.duration,
+        mix=mix,
+        results=results,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="Base URL of a running API, else in process.")
+    parser.add_argument("--team-name", help="Team to load, required with --url.")
+    parser.add_argument("--key", help="Key of the team, required with --url.")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(map(str, DEFAULT_SIZES)),
+        help="Comma separated environment sizes.",
+    )
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"Relative weights of the routes among {', '.join(ROUTES)}.",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per size.")
+    parser.add_argument("--warmup", type=int, default=20, help="Requests per size.")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        help="Of the app in process, INFO logs every request as deployed.",
+    )
+    parser.add_argument("--output", help="Write results here instead of stdout.")
+    args = parser.parse_args()
+
+    if args.url and not (args.team_name and args.key):
+        parser.error("--team-name and --key are required with --url")
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(f"Invalid --mix: {e}")
+
+    logging.basicConfig(level=args.log_level, force=True)
+    output = asyncio.run(main_async(args, mix)).model_dump_json(indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
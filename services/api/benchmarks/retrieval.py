@@ -0,0 +1,219 @@
+"""
+Benchmark `find_relevant_critiques` over synthetic corpora, offline.
+
+    python -m benchmarks.retrieval --sizes 100,1000,10000,100000 \
+        --output benchmarks/results/$(git rev-parse --short HEAD).json
+
+Every (size, retrieval) case runs in a fresh process with an empty cache
+directory, so cold numbers are really cold and peak RSS is the case's own.
+Embeddings come from `HashingEmbeddings`, so absolute cold numbers are lower
+than with BGE; `cold_embed_ms` is the part spent embedding. Results are JSON in
+a fixed field order, to diff between commits.
+"""
+
+import argparse
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pydantic import BaseModel
+
+DEFAULT_SIZES = [100, 1000, 10_000, 100_000]
+RETRIEVALS = ["dense", "bm25", "hybrid"]
+
+
+class Case(BaseModel):
+    size: int
+    retrieval: str
+    k: int
+    queries: int
+    storage: str
+    seed: int
+
+
+class Latency(BaseModel):
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+class CaseResult(Case):
+    approximate: bool
+    index_bytes: int
+    cold_ms: float
+    cold_embed_ms: float
+    warm: Latency
+    throughput_qps: float
+    corpus_rss_mb: float
+    peak_rss_mb: float
+
+
+class Metadata(BaseModel):
+    commit: str | None
+    python: str
+    numpy: str
+    platform: str
+    cpus: int | None
+    started_at: float
+
+
+class Results(BaseModel):
+    metadata: Metadata
+    results: list[CaseResult]
+
+
+def peak_rss_mb() -> float:
+    # Kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
+def run_case(case: Case) -> CaseResult:
+    """Runs in its own process; `src` reads its settings from the environment."""
+    from benchmarks.corpus import CorpusGenerator
+    from benchmarks.embeddings import use_hashing_embeddings
+    from src.lib import few_shot
+
+    model = use_hashing_embeddings()
+
+    generator = CorpusGenerator(case.seed)
+    critiques = generator.critiques(case.size)
+    queries = generator.queries(critiques, case.queries + 1)
+    corpus_rss = peak_rss_mb()
+
+    index = few_shot.CritiqueIndex()
+
+    def search(query: str) -> None:
+        few_shot.find_relevant_critiques(
+            critiques,
+            query,
+            k=case.k,
+            index=index,
+            prune=True,
+            retrieval=case.retrieval,  # type: ignore[arg-type]
+        )
+
+    start = time.perf_counter()
+    search(queries[0])
+    cold = time.perf_counter() - start
+    cold_embed = model.seconds
+
+    latencies = []
+    for query in queries[1:]:
+        start = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - start)
+    warm = 1000 * np.array(latencies)
+
+    stats = index.stats()
+    return CaseResult(
+        **case.model_dump(),
+        approximate=stats.approximate,
+        index_bytes=stats.bytes,
+        cold_ms=1000 * cold,
+        cold_embed_ms=1000 * cold_embed,
+        warm=Latency(
+            mean_ms=float(warm.mean()),
+            p50_ms=float(np.percentile(warm, 50)),
+            p95_ms=float(np.percentile(warm, 95)),
+            p99_ms=float(np.percentile(warm, 99)),
+        ),
+        throughput_qps=len(latencies) / sum(latencies),
+        corpus_rss_mb=corpus_rss,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(map(str, DEFAULT_SIZES)),
+        help="Comma separated corpus sizes.",
+    )
+    parser.add_argument(
+        "--retrieval",
+        default=",".join(RETRIEVALS),
+        help="Comma separated retrieval backends.",
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument(
+        "--storage", default="float32", choices=["float32", "float16", "int8"]
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results here instead of stdout.")
+    args = parser.parse_args()
+
+    retrievals = args.retrieval.split(",")
+    for retrieval in retrievals:
+        if retrieval not in RETRIEVALS:
+            parser.error(f"Unknown retrieval backend: {retrieval}")
+
+    metadata = Metadata(
+        commit=git_commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        started_at=time.time(),
+    )
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for retrieval in retrievals:
+            case = Case(
+                size=size,
+                retrieval=retrieval,
+                k=args.k,
+                queries=args.queries,
+                storage=args.storage,
+                seed=args.seed,
+            )
+            with tempfile.TemporaryDirectory() as cache_dir:
+                # Spawned workers import `src` afresh and read these
+                os.environ["CRITINO_CACHE_DIR"] = cache_dir
+                os.environ["CRITINO_INDEX_STORAGE"] = args.storage
+                with ProcessPoolExecutor(
+                    1, mp_context=multiprocessing.get_context("spawn")
+                ) as pool:
+                    result = pool.submit(run_case, case).result()
+
+            print(
+                f"{size:>7} {retrieval:<6} cold {result.cold_ms:9.1f} ms"
+                f"  warm p50 {result.warm.p50_ms:7.2f} ms"
+                f"  p95 {result.warm.p95_ms:7.2f} ms"
+                f"  {result.throughput_qps:8.1f} q/s"
+                f"  peak {result.peak_rss_mb:7.1f} MB",
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    output = Results(metadata=metadata, results=results).model_dump_json(indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,19 @@
+import asyncio
+import os
 import time
 import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 from dotenv import load_dotenv
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from requests import Request
 
-from src.routers import auth, critiques, index, environments
+from src.interfaces import db
+from src.lib import few_shot, jobs
+from src.routers import auth, critiques, index, environments, stats
+from src.routers import jobs as jobs_router
 
 load_dotenv()
 
@@ -18,8 +25,34 @@ logging.basicConfig(
 )
 
 
+# Load the embedding model in the background at startup instead of on the
+# first similarity request
+WARM_EMBEDDINGS = os.getenv("CRITINO_WARM_EMBEDDINGS", "true").lower() == "true"
+
+
+async def warm_embeddings() -> None:
+    try:
+        await asyncio.to_thread(few_shot.model.load)
+    except Exception as e:
+        logging.error(f"Failed to warm embedding model: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    app.state.supabase = db.client()
+    warm_task = asyncio.create_task(warm_embeddings()) if WARM_EMBEDDINGS else None
+    jobs.queue.start(app.state)
+    yield
+    if warm_task:
+        warm_task.cancel()
+    await jobs.queue.close()
+    await few_shot.batcher.close()
+    await asyncio.to_thread(few_shot.model.shutdown)
+    db.close(app.state.supabase)
+
+
 def create_app() -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
     @app.middleware("http")
     async def add_process_time_header(request: Request, call_next):
@@ -33,6 +66,8 @@ def create_app() -> FastAPI:
     app.include_router(auth.router)
     app.include_router(environments.router)
     app.include_router(critiques.router)
+    app.include_router(stats.router)
+    app.include_router(jobs_router.router)
 
     app.add_middleware(
         CORSMiddleware,
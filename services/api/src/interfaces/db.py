@@ -1,10 +1,22 @@
 import logging
 import os
+from typing import cast
 from dotenv import load_dotenv
+from fastapi import Request
 from supabase import create_client, Client
 
+from src.interfaces import memory_db
+
+# `supabase`, or `memory` for an in-process stand-in, see memory_db
+DB_BACKEND = os.getenv("CRITINO_DB", "supabase")
+
 
 def client() -> Client:
+    if DB_BACKEND == "memory":
+        return cast(Client, memory_db.MemoryClient.from_env())
+    if DB_BACKEND != "supabase":
+        raise ValueError(f"Unknown database backend: {DB_BACKEND}")
+
     logging.debug("Creating Supabase client")
     load_dotenv()
     url: str | None = os.environ.get("PUBLIC_SUPABASE_URL")
@@ -14,4 +26,24 @@ def client() -> Client:
         logging.error("PUBLIC_SUPABASE_URL and PUBLIC_SUPABASE_ANON_KEY must be set")
         raise ValueError("PUBLIC_SUPABASE_URL and PUBLIC_SUPABASE_ANON_KEY must be set")
 
-    return create_client(url, key)
+    supabase = create_client(url, key)
+    # PostgREST's session is created lazily, build it now so concurrent
+    # requests share one keep-alive (HTTP/2) connection pool
+    supabase.postgrest
+    return supabase
+
+
+def close(supabase: Client | memory_db.MemoryClient) -> None:
+    if isinstance(supabase, memory_db.MemoryClient):
+        return
+    supabase.postgrest.aclose()
+
+
+def get_client(request: Request) -> Client:
+    """
+    FastAPI dependency returning the application-wide client created in the
+    lifespan hook.
+    """
+    if getattr(request.app.state, "supabase", None) is None:
+        request.app.state.supabase = client()
+    return request.app.state.supabase
@@ -1,6 +1,19 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, TypeVar
+
 from langchain_openai.chat_models import ChatOpenAI
 from pydantic import SecretStr
 
+# Concurrent LLM calls allowed per team, across all of its requests
+LLM_CONCURRENCY = int(os.getenv("CRITINO_LLM_CONCURRENCY", "4"))
+# Seconds one generation may take, retries included, once it is running
+LLM_TIMEOUT = float(os.getenv("CRITINO_LLM_TIMEOUT", "60"))
+
+T = TypeVar("T")
+
+team_semaphores: dict[str, asyncio.Semaphore] = {}
+
 
 def chat_open_router(model: str, api_key: str, temperature: float = 0.7):
     return ChatOpenAI(
@@ -9,3 +22,21 @@ def chat_open_router(model: str, api_key: str, temperature: float = 0.7):
         api_key=SecretStr(api_key),
         base_url="https://openrouter.ai/api/v1",
     )
+
+
+def team_semaphore(team_name: str) -> asyncio.Semaphore:
+    if team_name not in team_semaphores:
+        team_semaphores[team_name] = asyncio.Semaphore(LLM_CONCURRENCY)
+    return team_semaphores[team_name]
+
+
+async def run_limited(
+    team_name: str, call: Callable[[], Awaitable[T]], timeout: float = LLM_TIMEOUT
+) -> T:
+    """
+    Await `call()` once one of the team's LLM slots is free, giving up with
+    `asyncio.TimeoutError` after `timeout` seconds. Time spent waiting for a
+    slot does not count against the timeout.
+    """
+    async with team_semaphore(team_name):
+        return await asyncio.wait_for(call(), timeout)
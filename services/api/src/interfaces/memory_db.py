@@ -0,0 +1,688 @@
+import bisect
+import copy
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable
+
+from postgrest.base_request_builder import APIResponse, SingleAPIResponse
+from postgrest.exceptions import APIError
+
+# Milliseconds every `execute` sleeps for, standing in for the round trip to
+# PostgREST, plus up to DB_LATENCY_JITTER_MS more at random
+DB_LATENCY_MS = float(os.getenv("CRITINO_DB_LATENCY_MS", "0"))
+DB_LATENCY_JITTER_MS = float(os.getenv("CRITINO_DB_LATENCY_JITTER_MS", "0"))
+# JSON file of rows to start with, e.g. `{"teams": [{"name": ..., "key": ...}]}`
+DB_SEED = os.getenv("CRITINO_DB_SEED")
+# Rows returned by a read at most, PostgREST's `max_rows` (web/supabase/config.toml)
+DB_MAX_ROWS = int(os.getenv("CRITINO_DB_MAX_ROWS", "1000"))
+
+Row = dict[str, Any]
+Predicate = Callable[[Row], bool]
+
+
+class TableSchema:
+    def __init__(
+        self,
+        primary_key: tuple[str, ...],
+        defaults: Row,
+        nullable: frozenset[str] = frozenset(),
+    ):
+        self.primary_key = primary_key
+        self.defaults = defaults
+        self.nullable = nullable
+
+    def default(self, column: str) -> Any:
+        if column == "created_at":
+            return datetime.now(timezone.utc).isoformat()
+        return copy.deepcopy(self.defaults.get(column))
+
+
+# The columns of the tables the API uses, see web/src/lib/supabase/database.types.ts
+SCHEMAS = {
+    "teams": TableSchema(
+        ("name",), {"icon_url": "", "key": None}, nullable=frozenset({"key"})
+    ),
+    "environments": TableSchema(
+        ("team_name", "name"),
+        {"description": "", "key": None, "parent_name": None},
+        nullable=frozenset({"key", "parent_name"}),
+    ),
+    "critiques": TableSchema(
+        ("id",),
+        {
+            "team_name": None,
+            "environment_name": None,
+            "context": "",
+            "query": "",
+            "optimal": "",
+            "response": "",
+            "situation": "",
+            "instructions": "",
+            "tab": "",
+            "tags": [],
+        },
+    ),
+}
+
+
+def api_error(code: str, message: str) -> APIError:
+    return APIError({"code": code, "message": message, "hint": "", "details": ""})
+
+
+def compare(operator: str, value: Any, operand: Any) -> bool:
+    # NULL matches nothing, as in SQL
+    if value is None:
+        return operator == "is" and str(operand).lower() == "null"
+    if operator == "is":
+        return str(value).lower() == str(operand).lower()
+    if operator in ("like", "ilike"):
+        pattern = "".join(
+            ".*" if char in "*%" else re.escape(char) for char in str(operand)
+        )
+        flags = re.IGNORECASE | re.DOTALL if operator == "ilike" else re.DOTALL
+        return re.fullmatch(pattern, str(value), flags) is not None
+
+    # Operands parsed from a logic tree are strings
+    if isinstance(value, (int, float)) and isinstance(operand, str):
+        operand = type(value)(operand)
+    if operator == "eq":
+        return value == operand
+    if operator == "neq":
+        return value != operand
+    if operator == "gt":
+        return value > operand
+    if operator == "gte":
+        return value >= operand
+    if operator == "lt":
+        return value < operand
+    if operator == "lte":
+        return value <= operand
+    raise api_error("PGRST100", f"Unsupported operator: {operator}")
+
+
+Bounds = dict[str, Any]
+
+
+def shared_bounds(bounds: list[Bounds]) -> Bounds:
+    """Lower bounds every alternative implies, the least of each column's."""
+    columns = set.intersection(*(set(bound) for bound in bounds)) if bounds else set()
+    try:
+        return {column: min(bound[column] for bound in bounds) for column in columns}
+    except TypeError:
+        return {}
+
+
+class LogicParser:
+    """
+    Parser of PostgREST logic trees as passed to `or_`, e.g.
+    `created_at.gt."t",and(created_at.eq."t",id.gt."x")`. Along with the
+    predicates, conditions report the lower bounds they imply on columns, so
+    ordered reads can seek to the first row that can match.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.position = 0
+
+    def parse(self) -> list[tuple[Predicate, Bounds]]:
+        conditions = self.conditions()
+        if self.position != len(self.text):
+            raise self.error()
+        return conditions
+
+    def error(self) -> APIError:
+        return api_error("PGRST100", f"Failed to parse logic tree: {self.text}")
+
+    def conditions(self) -> list[tuple[Predicate, Bounds]]:
+        conditions = [self.condition()]
+        while self.peek(","):
+            self.position += 1
+            conditions.append(self.condition())
+        return conditions
+
+    def condition(self) -> tuple[Predicate, Bounds]:
+        negated = self.text.startswith("not.", self.position)
+        if negated:
+            self.position += len("not.")
+
+        for group, combine in (("and(", all), ("or(", any)):
+            if self.text.startswith(group, self.position):
+                self.position += len(group)
+                conditions = self.conditions()
+                if not self.peek(")"):
+                    raise self.error()
+                self.position += 1
+                predicate = self.group(
+                    combine, [predicate for predicate, _ in conditions]
+                )
+                bounds = (
+                    {
+                        column: value
+                        for _, bound in conditions
+                        for column, value in bound.items()
+                    }
+                    if combine is all
+                    else shared_bounds([bound for _, bound in conditions])
+                )
+                break
+        else:
+            column, operator = self.word(), self.word()
+            value = self.value()
+            predicate = self.comparison(column, operator, value)
+            bounds = {column: value} if operator in ("eq", "gt", "gte") else {}
+
+        if negated:
+            return (lambda row: not predicate(row)), {}
+        return predicate, bounds
+
+    @staticmethod
+    def group(
+        combine: Callable[[Iterable[bool]], bool], predicates: list[Predicate]
+    ) -> Predicate:
+        return lambda row: combine(predicate(row) for predicate in predicates)
+
+    @staticmethod
+    def comparison(column: str, operator: str, operand: str) -> Predicate:
+        return lambda row: compare(operator, row.get(column), operand)
+
+    def peek(self, char: str) -> bool:
+        return self.text.startswith(char, self.position)
+
+    def word(self) -> str:
+        end = self.text.find(".", self.position)
+        if end == -1:
+            raise self.error()
+        word, self.position = self.text[self.position : end], end + 1
+        return word
+
+    def value(self) -> str:
+        if not self.peek('"'):
+            match = re.compile(r"[^,()]*").match(self.text, self.position)
+            assert match is not None
+            self.position = match.end()
+            return match.group()
+
+        value = []
+        self.position += 1
+        while self.position < len(self.text):
+            char = self.text[self.position]
+            self.position += 1
+            if char == "\\" and self.position < len(self.text):
+                value.append(self.text[self.position])
+                self.position += 1
+            elif char == '"':
+                return "".join(value)
+            else:
+                value.append(char)
+        raise self.error()
+
+
+class MemoryQuery:
+    """
+    A request against one table, built by chaining like postgrest-py's
+    request builders and run by `execute`.
+    """
+
+    def __init__(self, client: "MemoryClient", table: str):
+        self.client = client
+        self.table = table
+        self.action = "select"
+        self.columns: list[str] | None = None
+        self.payload: list[Row] = []
+        # Columns of a bulk write, missing keys are written as NULL or, with
+        # `default_to_null=False`, as the column default
+        self.payload_columns: set[str] = set()
+        self.default_to_null = True
+        self.on_conflict: tuple[str, ...] | None = None
+        self.ignore_duplicates = False
+        self.predicates: list[Predicate] = []
+        # Values of `eq` filters, to look rows up by primary key, and lower
+        # bounds of columns, to seek in ordered reads
+        self.equals: Row = {}
+        self.bounds: Bounds = {}
+        self.orders: list[tuple[str, bool]] = []
+        self.row_limit: int | None = None
+        self.is_single = False
+
+    def select(self, *columns: str, **_: Any) -> "MemoryQuery":
+        names = [
+            name.strip() for column in columns for name in column.split(",") if name
+        ]
+        self.columns = None if not names or "*" in names else names
+        return self
+
+    def write(self, json: Row | list[Row], default_to_null: bool) -> None:
+        # postgrest-py sends `columns` with the union of a list's keys
+        if isinstance(json, list):
+            self.payload = json
+            self.payload_columns = {key for row in json for key in row}
+        else:
+            self.payload = [json]
+        self.default_to_null = default_to_null
+
+    def insert(
+        self,
+        json: Row | list[Row],
+        *,
+        upsert: bool = False,
+        default_to_null: bool = True,
+        **_: Any,
+    ) -> "MemoryQuery":
+        self.action = "upsert" if upsert else "insert"
+        self.write(json, default_to_null)
+        return self
+
+    def upsert(
+        self,
+        json: Row | list[Row],
+        *,
+        ignore_duplicates: bool = False,
+        on_conflict: str = "",
+        default_to_null: bool = True,
+        **_: Any,
+    ) -> "MemoryQuery":
+        self.action = "upsert"
+        self.write(json, default_to_null)
+        self.ignore_duplicates = ignore_duplicates
+        if on_conflict:
+            self.on_conflict = tuple(
+                column.strip() for column in on_conflict.split(",")
+            )
+        return self
+
+    def update(self, json: Row, **_: Any) -> "MemoryQuery":
+        self.action = "update"
+        self.payload = [json]
+        return self
+
+    def delete(self, **_: Any) -> "MemoryQuery":
+        self.action = "delete"
+        return self
+
+    def filter(self, column: str, operator: str, value: Any) -> "MemoryQuery":
+        self.predicates.append(lambda row: compare(operator, row.get(column), value))
+        return self
+
+    def eq(self, column: str, value: Any) -> "MemoryQuery":
+        self.equals[column] = value
+        self.bounds[column] = value
+        return self.filter(column, "eq", value)
+
+    def neq(self, column: str, value: Any) -> "MemoryQuery":
+        return self.filter(column, "neq", value)
+
+    def gt(self, column: str, value: Any) -> "MemoryQuery":
+        self.bounds[column] = value
+        return self.filter(column, "gt", value)
+
+    def gte(self, column: str, value: Any) -> "MemoryQuery":
+        self.bounds[column] = value
+        return self.filter(column, "gte", value)
+
+    def lt(self, column: str, value: Any) -> "MemoryQuery":
+        return self.filter(column, "lt", value)
+
+    def lte(self, column: str, value: Any) -> "MemoryQuery":
+        return self.filter(column, "lte", value)
+
+    def like(self, column: str, pattern: str) -> "MemoryQuery":
+        return self.filter(column, "like", pattern)
+
+    def ilike(self, column: str, pattern: str) -> "MemoryQuery":
+        return self.filter(column, "ilike", pattern)
+
+    def in_(self, column: str, values: Iterable[Any]) -> "MemoryQuery":
+        values = list(values)
+        self.predicates.append(lambda row: row.get(column) in values)
+        return self
+
+    def contains(self, column: str, values: Iterable[Any]) -> "MemoryQuery":
+        values = list(values)
+        self.predicates.append(
+            lambda row: row.get(column) is not None
+            and all(value in row[column] for value in values)
+        )
+        return self
+
+    def or_(self, filters: str, **_: Any) -> "MemoryQuery":
+        conditions = LogicParser(filters).parse()
+        predicates = [predicate for predicate, _ in conditions]
+        self.predicates.append(
+            lambda row: any(predicate(row) for predicate in predicates)
+        )
+        self.bounds.update(shared_bounds([bounds for _, bounds in conditions]))
+        return self
+
+    def order(self, column: str, *, desc: bool = False, **_: Any) -> "MemoryQuery":
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, size: int, **_: Any) -> "MemoryQuery":
+        self.row_limit = size
+        return self
+
+    def single(self) -> "MemoryQuery":
+        self.is_single = True
+        return self
+
+    def execute(self) -> APIResponse:
+        self.client.wait()
+        with self.client.lock:
+            rows = getattr(self.client, f"run_{self.action}")(self)
+            if self.action != "select":
+                self.client.versions[self.table] += 1
+            rows = [
+                (
+                    copy.deepcopy(row)
+                    if self.columns is None
+                    else {
+                        column: copy.deepcopy(row.get(column))
+                        for column in self.columns
+                    }
+                )
+                for row in rows
+            ]
+
+        if self.is_single:
+            if len(rows) != 1:
+                raise api_error(
+                    "PGRST116",
+                    "JSON object requested, multiple (or no) rows returned",
+                )
+            return SingleAPIResponse(data=rows[0], count=None)
+        return APIResponse(data=rows, count=None)
+
+
+class MemoryRPC:
+    def __init__(self, client: "MemoryClient", name: str, params: Row):
+        self.client = client
+        self.name = name
+        self.params = params
+
+    def execute(self) -> APIResponse:
+        self.client.wait()
+        function = self.client.functions.get(self.name)
+        if function is None:
+            raise api_error(
+                "PGRST202",
+                f"Could not find the function public.{self.name} in the schema cache",
+            )
+        with self.client.lock:
+            rows = function(**self.params)
+        return APIResponse(data=rows[: self.client.max_rows], count=None)
+
+
+class MemoryClient:
+    """
+    In-process stand-in for the parts of the Supabase client the API uses,
+    with tables shaped like `teams`, `environments` and `critiques` and the
+    `auth_keys` function. Every `execute` sleeps for `latency` seconds (plus
+    up to `jitter`) in place of the network round trip, so the full request
+    path, auth included, can be profiled and load tested without a project.
+
+    Like PostgREST, reads return at most `max_rows` rows, bulk writes set the
+    keys a row lacks to NULL unless `default_to_null=False`, and NOT NULL
+    columns reject the statement as a whole. Rows live in the process: each
+    worker has its own database. Filters scan the table, and foreign keys
+    and row level security are not enforced.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        jitter: float = 0,
+        max_rows: int = DB_MAX_ROWS,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.max_rows = max_rows
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.tables: dict[str, dict[tuple, Row]] = {name: {} for name in SCHEMAS}
+        # Rows of a table sorted by an order, kept until the table changes
+        self.versions = {name: 0 for name in SCHEMAS}
+        self.sorted: dict[
+            tuple[str, tuple[tuple[str, bool], ...]], tuple[int, list[Row]]
+        ] = {}
+        self.functions: dict[str, Callable[..., list[Row]]] = {
+            "auth_keys": self.auth_keys
+        }
+
+    @classmethod
+    def from_env(cls) -> "MemoryClient":
+        client = cls(latency=DB_LATENCY_MS / 1000, jitter=DB_LATENCY_JITTER_MS / 1000)
+        if DB_SEED:
+            with open(DB_SEED) as file:
+                client.seed(json.load(file))
+        logging.info(
+            f"memory_db: using the in-memory database, {DB_LATENCY_MS}ms latency"
+        )
+        return client
+
+    def seed(self, tables: dict[str, list[Row]]) -> None:
+        """Upsert rows by table name, e.g. from a JSON fixture."""
+        for table, rows in tables.items():
+            self.table(table).upsert(rows).execute()
+
+    def table(self, name: str) -> MemoryQuery:
+        if name not in SCHEMAS:
+            raise api_error("42P01", f'relation "public.{name}" does not exist')
+        return MemoryQuery(self, name)
+
+    def rpc(self, name: str, params: Row | None = None, **_: Any) -> MemoryRPC:
+        return MemoryRPC(self, name, params or {})
+
+    def wait(self) -> None:
+        delay = self.latency + self.jitter * self.random.random()
+        if delay > 0:
+            time.sleep(delay)
+
+    def ordered(self, table: str, orders: list[tuple[str, bool]]) -> list[Row]:
+        key = (table, tuple(orders))
+        cached = self.sorted.get(key)
+        if cached is not None and cached[0] == self.versions[table]:
+            return cached[1]
+
+        rows = list(self.tables[table].values())
+        # Stable sorts from the last key to the first sort by all of them
+        for column, desc in reversed(orders):
+            rows.sort(
+                # Nulls sort last ascending and first descending, as in SQL
+                key=lambda row: (row.get(column) is None, row.get(column)),
+                reverse=desc,
+            )
+        self.sorted[key] = (self.versions[table], rows)
+        return rows
+
+    @staticmethod
+    def seek(rows: list[Row], column: str, bound: Any) -> Iterable[Row]:
+        """Rows from the first whose `column` is at least `bound`, ascending."""
+        try:
+            start = bisect.bisect_left(
+                rows,
+                (False, bound),
+                key=lambda row: (row.get(column) is None, row.get(column)),
+            )
+        except TypeError:
+            return rows
+        return itertools.islice(rows, start, None)
+
+    def filtered(self, query: MemoryQuery) -> list[Row]:
+        """
+        Rows matching the query in its order. Primary key lookups skip the
+        scan, and ordered reads stop at the limit.
+        """
+        table = self.tables[query.table]
+        primary_key = SCHEMAS[query.table].primary_key
+        candidates: Iterable[Row]
+        if all(column in query.equals for column in primary_key):
+            row = table.get(tuple(query.equals[column] for column in primary_key))
+            candidates = [row] if row is not None else []
+        elif query.orders:
+            candidates = self.ordered(query.table, query.orders)
+            column, desc = query.orders[0]
+            if not desc and column in query.bounds:
+                candidates = self.seek(candidates, column, query.bounds[column])
+        else:
+            candidates = table.values()
+
+        rows = []
+        for row in candidates:
+            if all(predicate(row) for predicate in query.predicates):
+                rows.append(row)
+                if len(rows) == query.row_limit:
+                    break
+        return rows
+
+    def key(self, table: str, row: Row, columns: tuple[str, ...]) -> tuple:
+        self.check(table, {column: row.get(column) for column in columns})
+        return tuple(row[column] for column in columns)
+
+    def check(self, table: str, row: Row) -> None:
+        for column, value in row.items():
+            if value is None and column not in SCHEMAS[table].nullable:
+                raise api_error(
+                    "23502",
+                    f'null value in column "{column}" of relation "{table}" violates not-null constraint',
+                )
+
+    def complete(self, query: MemoryQuery, row: Row) -> Row:
+        """The row as written: with the columns of a bulk write it lacks."""
+        schema = SCHEMAS[query.table]
+        return {
+            **{
+                column: None if query.default_to_null else schema.default(column)
+                for column in query.payload_columns
+                if column not in row
+            },
+            **copy.deepcopy(row),
+        }
+
+    def new_row(self, table: str, row: Row) -> Row:
+        schema = SCHEMAS[table]
+        row = {
+            **{
+                column: schema.default(column)
+                for column in ["created_at", *schema.defaults]
+                if column not in row
+            },
+            **row,
+        }
+        self.check(table, row)
+        return row
+
+    def run_select(self, query: MemoryQuery) -> list[Row]:
+        rows = self.filtered(query)
+        return rows[: self.max_rows]
+
+    def run_insert(self, query: MemoryQuery) -> list[Row]:
+        table = self.tables[query.table]
+        primary_key = SCHEMAS[query.table].primary_key
+        rows = [
+            self.new_row(query.table, self.complete(query, row))
+            for row in query.payload
+        ]
+        keys = [self.key(query.table, row, primary_key) for row in rows]
+        if len(set(keys)) != len(keys) or any(key in table for key in keys):
+            raise api_error(
+                "23505",
+                f'duplicate key value violates unique constraint "{query.table}_pkey"',
+            )
+        table.update(zip(keys, rows))
+        return rows
+
+    def run_upsert(self, query: MemoryQuery) -> list[Row]:
+        """
+        Every row is checked before any is written, so a failing row fails
+        the whole statement as in Postgres.
+        """
+        table = self.tables[query.table]
+        primary_key = SCHEMAS[query.table].primary_key
+        conflict = query.on_conflict or primary_key
+        existing = (
+            {
+                tuple(row.get(column) for column in conflict): key
+                for key, row in table.items()
+            }
+            if conflict != primary_key
+            else None
+        )
+
+        changes: list[tuple[tuple | None, tuple, Row]] = []
+        seen = set()
+        for payload in query.payload:
+            payload = self.complete(query, payload)
+            conflict_key = self.key(query.table, payload, conflict)
+            if conflict_key in seen:
+                raise api_error(
+                    "21000",
+                    "ON CONFLICT DO UPDATE command cannot affect row a second time",
+                )
+            seen.add(conflict_key)
+
+            match = (
+                existing.get(conflict_key)
+                if existing is not None
+                else conflict_key if conflict_key in table else None
+            )
+            if match is None:
+                row = self.new_row(query.table, payload)
+            elif query.ignore_duplicates:
+                continue
+            else:
+                row = {**table[match], **payload}
+                self.check(query.table, row)
+            changes.append((match, self.key(query.table, row, primary_key), row))
+
+        for match, key, row in changes:
+            if match is not None:
+                del table[match]
+            table[key] = row
+        return [row for _, _, row in changes]
+
+    def run_update(self, query: MemoryQuery) -> list[Row]:
+        table = self.tables[query.table]
+        primary_key = SCHEMAS[query.table].primary_key
+        changes = []
+        for row in self.filtered(query):
+            updated = {**row, **copy.deepcopy(query.payload[0])}
+            self.check(query.table, updated)
+            changes.append((self.key(query.table, row, primary_key), updated))
+
+        for key, row in changes:
+            del table[key]
+        for _, row in changes:
+            table[self.key(query.table, row, primary_key)] = row
+        return [row for _, row in changes]
+
+    def run_delete(self, query: MemoryQuery) -> list[Row]:
+        table = self.tables[query.table]
+        primary_key = SCHEMAS[query.table].primary_key
+        rows = self.filtered(query)
+        for row in rows:
+            del table[self.key(query.table, row, primary_key)]
+        return rows
+
+    def auth_keys(
+        self, team_name: str, environment_names: list[str] | None = None
+    ) -> list[Row]:
+        """See web/supabase/migrations/*_auth_keys.sql"""
+        environment_names = environment_names or []
+        team = self.tables["teams"].get((team_name,))
+        return [
+            *([{"environment_name": None, "key": team["key"]}] if team else []),
+            *(
+                {"environment_name": environment["name"], "key": environment["key"]}
+                for environment in self.tables["environments"].values()
+                if environment["team_name"] == team_name
+                and environment["name"] in environment_names
+            ),
+        ]
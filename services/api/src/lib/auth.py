@@ -1,21 +1,169 @@
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 from fastapi import HTTPException
 from supabase import PostgrestAPIError
 from supabase._sync.client import SyncClient
 
 from src.lib import keys
 
+# Seconds a key is trusted once allowed. The web UI rotates and deletes keys
+# directly in Supabase, so a key revoked there keeps working for up to this
+# long; 0 checks every request against the database
+AUTH_CACHE_TTL = float(os.getenv("CRITINO_AUTH_CACHE_TTL", "5"))
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv("CRITINO_AUTH_CACHE_NEGATIVE_TTL", "5"))
+AUTH_CACHE_MAX_ITEMS = int(os.getenv("CRITINO_AUTH_CACHE_MAX_ITEMS", "10000"))
+
+# Postgres function returning team and environment keys in one call, see
+# web/supabase/migrations/*_auth_keys.sql
+AUTH_KEYS_RPC = "auth_keys"
+# PostgREST's error code for a function missing from its schema cache
+MISSING_FUNCTION = "PGRST202"
+
+
+class DecisionCache:
+    """
+    Short-lived allow/deny decisions keyed by (team, environment, key hash).
+    Environment is None for team-only checks. Invalidation is per process
+    and only covers keys changed through this API: other workers, and every
+    worker for keys rotated or deleted in the web UI, keep the old decision
+    for at most the TTL.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_items: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_items = max_items
+        self.decisions: OrderedDict[tuple[str, str | None, str], tuple[bool, float]] = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def get(
+        self, team_name: str, environment_name: str | None, crypt: str
+    ) -> bool | None:
+        key = (team_name, environment_name, crypt)
+        with self.lock:
+            decision = self.decisions.get(key)
+            if decision is None:
+                return None
+            if decision[1] <= time.monotonic():
+                del self.decisions[key]
+                return None
+            self.decisions.move_to_end(key)
+            return decision[0]
+
+    def set(
+        self, team_name: str, environment_name: str | None, crypt: str, allowed: bool
+    ) -> None:
+        ttl = self.ttl if allowed else self.negative_ttl
+        if ttl <= 0:
+            return
+        expires = time.monotonic() + ttl
+        with self.lock:
+            self.decisions[(team_name, environment_name, crypt)] = (allowed, expires)
+            self.decisions.move_to_end((team_name, environment_name, crypt))
+            while len(self.decisions) > self.max_items:
+                self.decisions.popitem(last=False)
+
+    def invalidate(self, team_name: str, environment_name: str | None = None) -> None:
+        """
+        Forget decisions of a team, or of an environment and its descendants,
+        whose keys it can grant.
+        """
+        with self.lock:
+            for key in list(self.decisions):
+                team, environment, _ = key
+                if team != team_name:
+                    continue
+                if (
+                    environment_name is None
+                    or environment == environment_name
+                    or (environment or "").startswith(environment_name + "/")
+                ):
+                    del self.decisions[key]
+
+
+decisions = DecisionCache(
+    ttl=AUTH_CACHE_TTL,
+    negative_ttl=AUTH_CACHE_NEGATIVE_TTL,
+    max_items=AUTH_CACHE_MAX_ITEMS,
+)
+
+rpc_available = True
+
+
+def environment_prefixes(environment_name: str) -> list[str]:
+    """`a/b/c` -> `["a", "a/b", "a/b/c"]`, every environment whose key applies"""
+    parts = environment_name.split("/")
+    return ["/".join(parts[: i + 1]) for i in range(len(parts))]
+
+
+def fetch_keys_from_tables(
+    supabase: SyncClient, team_name: str, environment_names: list[str]
+) -> list[str | None]:
+    """
+    Stand-in for the `auth_keys` function using plain table reads, for
+    databases without the migration. Costs a second round trip when
+    environments are requested.
+    """
+    teams = supabase.table("teams").select("key").eq("name", team_name).execute()
+    valid_keys = [team["key"] for team in teams.data]
+    if environment_names:
+        environments = (
+            supabase.table("environments")
+            .select("key")
+            .eq("team_name", team_name)
+            .in_("name", environment_names)
+            .execute()
+        )
+        valid_keys += [environment["key"] for environment in environments.data]
+    return valid_keys
+
+
+def fetch_keys(
+    supabase: SyncClient, team_name: str, environment_names: list[str]
+) -> list[str | None]:
+    """
+    Encrypted keys of a team and of the given environments, in a single call
+    to the `auth_keys` function when the database has it.
+    """
+    global rpc_available
+    if rpc_available:
+        try:
+            rows = (
+                supabase.rpc(
+                    AUTH_KEYS_RPC,
+                    {"team_name": team_name, "environment_names": environment_names},
+                )
+                .execute()
+                .data
+            )
+            return [row["key"] for row in rows]
+        except PostgrestAPIError as e:
+            if e.code != MISSING_FUNCTION:
+                raise
+            logging.warning(
+                f"auth: '{AUTH_KEYS_RPC}' function missing, using table queries"
+            )
+            rpc_available = False
+
+    return fetch_keys_from_tables(supabase, team_name, environment_names)
+
 
 def authenticate_team(supabase: SyncClient, team_name: str, key: str):
+    crypt = keys.encrypt_key(key)
+    allowed = decisions.get(team_name, None, crypt)
+    if allowed is not None:
+        if not allowed:
+            raise HTTPException(status_code=401, detail="Unauthorized. Invalid key.")
+        return
+
     logging.info(f"Authenticating team: {team_name}")
     try:
-        team_key = (
-            supabase.table("teams")
-            .select("key")
-            .eq("name", team_name)
-            .single()
-            .execute()
-        ).data["key"]
+        valid_keys = fetch_keys(supabase, team_name, [])
     except PostgrestAPIError as e:
         logging.error(f"PostgrestAPIError: {e}")
         raise HTTPException(status_code=500, detail={**e.json()})
@@ -23,10 +171,11 @@ def authenticate_team(supabase: SyncClient, team_name: str, key: str):
         logging.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail={**e.__dict__})
 
-    logging.info(f"Valid crypts: {[team_key]}")
-    logging.info(f"Provided crypt: {keys.encrypt_key(key)}")
+    logging.info(f"Valid crypts: {valid_keys}")
+    logging.info(f"Provided crypt: {crypt}")
     logging.info(f"Provided key: {key}")
-    if team_key != keys.encrypt_key(key):
+    decisions.set(team_name, None, crypt, crypt in valid_keys)
+    if crypt not in valid_keys:
         raise HTTPException(status_code=401, detail="Unauthorized. Invalid key.")
 
 
@@ -40,35 +189,18 @@ def authenticate_team_or_environment(
     if key == "":
         raise HTTPException(status_code=401, detail="Unauthorized. Key Empty.")
 
+    crypt = keys.encrypt_key(key)
+    allowed = decisions.get(team_name, environment_name, crypt)
+    if allowed is not None:
+        if not allowed:
+            raise HTTPException(status_code=401, detail="Unauthorized. Invalid key.")
+        return
+
     logging.info(f"Authenticating team: {team_name} or environment: {environment_name}")
     try:
-        valid_keys = [
-            (
-                supabase.table("teams")
-                .select("key")
-                .eq("name", team_name)
-                .single()
-                .execute()
-            ).data["key"]
-        ]
-
-        # Split the environment_name by '/'
-        parts = environment_name.split("/")
-
-        # Generate all possible prefixes
-        prefixes = ["/".join(parts[: i + 1]) for i in range(len(parts))]
-
-        # Query the database for all prefixes in a single call
-        result = (
-            supabase.table("environments")
-            .select("key")
-            .eq("team_name", team_name)
-            .in_("name", prefixes)
-            .execute()
+        valid_keys = fetch_keys(
+            supabase, team_name, environment_prefixes(environment_name)
         )
-
-        # Extract the keys from the result
-        valid_keys += [item["key"] for item in result.data]
     except PostgrestAPIError as e:
         logging.error(f"PostgrestAPIError: {e}")
         raise HTTPException(status_code=500, detail={**e.json()})
@@ -77,7 +209,8 @@ def authenticate_team_or_environment(
         raise HTTPException(status_code=500, detail={**e.__dict__})
 
     logging.info(f"Valid crypts: {valid_keys}")
-    logging.info(f"Provided crypt: {keys.encrypt_key(key)}")
+    logging.info(f"Provided crypt: {crypt}")
     logging.info(f"Provided key: {key}")
-    if keys.encrypt_key(key) not in valid_keys:
+    decisions.set(team_name, environment_name, crypt, crypt in valid_keys)
+    if crypt not in valid_keys:
         raise HTTPException(status_code=401, detail="Unauthorized. Invalid key.")
@@ -0,0 +1,89 @@
+import heapq
+import math
+import re
+from collections import Counter
+from typing import Collection
+
+# Words, numbers and identifiers such as tool names or error codes, which
+# keep their underscores
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    """
+    Merge rankings of the same documents by summing 1 / (k + rank), which
+    needs no calibration between the scores of different retrievers.
+    """
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0) + 1 / (k + rank + 1)
+    return sorted(scores, key=lambda id: -scores[id])
+
+
+class BM25Index:
+    """
+    Inverted index scored with Okapi BM25. Documents are added and removed
+    one at a time; only the postings of their own terms change.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict[str, int]] = {}
+        self.lengths: dict[str, int] = {}
+        self.terms: dict[str, list[str]] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, id: str, text: str) -> None:
+        self.remove(id)
+        counts = Counter(tokenize(text))
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[id] = count
+        self.terms[id] = list(counts)
+        self.lengths[id] = sum(counts.values())
+        self.total_length += self.lengths[id]
+
+    def remove(self, id: str) -> None:
+        if id not in self.lengths:
+            return
+        for term in self.terms.pop(id):
+            posting = self.postings[term]
+            del posting[id]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(id)
+
+    def search(
+        self, text: str, k: int, ids: Collection[str] | None = None
+    ) -> list[tuple[str, float]]:
+        """Top `k` (id, score) matches of `text`, restricted to `ids`."""
+        if not self.lengths:
+            return []
+
+        count = len(self.lengths)
+        average_length = self.total_length / count or 1
+        scores: dict[str, float] = {}
+        for term in set(tokenize(text)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for id, frequency in posting.items():
+                if ids is not None and id not in ids:
+                    continue
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.lengths[id] / average_length
+                )
+                scores[id] = scores.get(id, 0) + idf * frequency * (self.k1 + 1) / (
+                    frequency + norm
+                )
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
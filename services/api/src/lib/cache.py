@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Callable
+
+from diskcache import Cache
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel
+
+from src.lib.embeddings import embed_queries
+
+CACHE_DIR = os.getenv("CRITINO_CACHE_DIR", ".cache/critino")
+EMBEDDING_CACHE_SIZE_LIMIT = int(
+    os.getenv("CRITINO_EMBEDDING_CACHE_SIZE_LIMIT", str(512 * 1024**2))
+)
+SITUATION_CACHE_SIZE_LIMIT = int(
+    os.getenv("CRITINO_SITUATION_CACHE_SIZE_LIMIT", str(64 * 1024**2))
+)
+SITUATION_CACHE_MEMORY_ITEMS = int(
+    os.getenv("CRITINO_SITUATION_CACHE_MEMORY_ITEMS", "1024")
+)
+SITUATION_CACHE_TTL = float(os.getenv("CRITINO_SITUATION_CACHE_TTL", "604800"))
+
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    size: int
+    volume: int
+
+
+class TieredCacheStats(CacheStats):
+    memory_hits: int
+    memory_size: int
+
+
+def open_cache(name: str, size_limit: int) -> Cache:
+    """
+    Open a named disk cache under `CACHE_DIR`. SQLite backed, so it is shared
+    by every worker on the host and survives restarts.
+    """
+    return Cache(
+        os.path.join(CACHE_DIR, name),
+        size_limit=size_limit,
+        eviction_policy="least-recently-used",
+    )
+
+
+def normalize_text(text: str) -> str:
+    # BGE's tokenizer splits on any whitespace, so collapsing it is lossless
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Content-addressed cache in front of an embedding model. Entries are keyed
+    by model name, kind (query or document, BGE embeds them differently) and
+    the hash of the normalized text.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: Cache):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind: str, text: str) -> str:
+        return f"{self.model_name}:{kind}:{hash_text(text)}"
+
+    def embed(
+        self,
+        kind: str,
+        texts: list[str],
+        embed: Callable[[list[str]], list[list[float]]],
+    ) -> list[list[float]]:
+        texts = [normalize_text(text) for text in texts]
+        vectors: list[list[float]] = [[] for _ in texts]
+        missing: dict[str, list[int]] = {}
+
+        for i, text in enumerate(texts):
+            cached = self.cache.get(self.key(kind, text))
+            if cached is None:
+                missing.setdefault(text, []).append(i)
+            else:
+                vectors[i] = array("f", cached).tolist()
+
+        misses = sum(len(ids) for ids in missing.values())
+        self.hits += len(texts) - misses
+        self.misses += misses
+
+        if missing:
+            logging.debug(f"cache: embedding {len(missing)} uncached {kind} texts")
+            for (text, ids), vector in zip(missing.items(), embed(list(missing))):
+                self.cache.set(self.key(kind, text), array("f", vector).tobytes())
+                for i in ids:
+                    vectors[i] = vector
+
+        return vectors
+
+    def cached(self, kind: str, text: str) -> list[float] | None:
+        """The text's vector if it is cached, without embedding it otherwise."""
+        cached = self.cache.get(self.key(kind, normalize_text(text)))
+        if cached is None:
+            return None
+        self.hits += 1
+        return array("f", cached).tolist()
+
+    def cached_query(self, text: str) -> list[float] | None:
+        return self.cached("query", text)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed("document", texts, self.embeddings.embed_documents)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        return self.embed("query", texts, partial(embed_queries, self.embeddings))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_queries([text])[0]
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            size=len(self.cache),
+            volume=self.cache.volume(),
+        )
+
+
+class TieredCache:
+    """
+    In-memory LRU in front of a disk cache, both expiring entries after
+    `ttl` seconds. The memory tier serves hot keys without touching SQLite;
+    the disk tier is shared between workers and survives restarts.
+    """
+
+    def __init__(self, cache: Cache, max_items: int, ttl: float):
+        self.cache = cache
+        self.max_items = max_items
+        self.ttl = ttl
+        self.memory: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Any | None:
+        with self.lock:
+            if key in self.memory:
+                value, expires = self.memory[key]
+                if expires > time.time():
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self.memory[key]
+
+        value, expires = self.cache.get(key, expire_time=True)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.remember(key, value, expires or time.time() + self.ttl)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.cache.set(key, value, expire=self.ttl)
+        self.remember(key, value, time.time() + self.ttl)
+
+    def remember(self, key: str, value: Any, expires: float) -> None:
+        with self.lock:
+            self.memory[key] = (value, expires)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def stats(self) -> TieredCacheStats:
+        return TieredCacheStats(
+            hits=self.memory_hits + self.hits,
+            misses=self.misses,
+            size=len(self.cache),
+            volume=self.cache.volume(),
+            memory_hits=self.memory_hits,
+            memory_size=len(self.memory),
+        )
+
+
+# Situations generated by the LLM, keyed by model and truncated context
+situations = TieredCache(
+    open_cache("situations", size_limit=SITUATION_CACHE_SIZE_LIMIT),
+    max_items=SITUATION_CACHE_MEMORY_ITEMS,
+    ttl=SITUATION_CACHE_TTL,
+)
@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Literal, TypeVar, get_args
+
+from fastapi import HTTPException
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel
+
+
+def embed_queries(embeddings: Embeddings, texts: list[str]) -> list[list[float]]:
+    """
+    Embed several queries in one forward pass. `Embeddings` only has a
+    single-query method, but for BGE a query is a document with the query
+    instruction prepended.
+    """
+    if isinstance(embeddings, EmbeddingExecutor):
+        return embeddings.embed_queries(texts)
+    if isinstance(embeddings, LazyEmbeddings):
+        embeddings = embeddings.load()
+
+    query_instruction = getattr(embeddings, "query_instruction", None)
+    if query_instruction is None or bool(
+        getattr(embeddings, "embed_instruction", None)
+    ):
+        return [embeddings.embed_query(text) for text in texts]
+
+    return embeddings.embed_documents([query_instruction + text for text in texts])
+
+
+class LazyEmbeddings(Embeddings):
+    """
+    Defers building an embedding model (and importing torch through
+    sentence-transformers) until it is first needed, or until `load` is called
+    from a background warm-up. Safe to call from several threads; only one of
+    them loads.
+    """
+
+    def __init__(self, load: Callable[[], Embeddings]):
+        self._load = load
+        self._lock = threading.Lock()
+        self.model: Embeddings | None = None
+        self.error: Exception | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.model is not None
+
+    def load(self) -> Embeddings:
+        if self.model is not None:
+            return self.model
+
+        with self._lock:
+            if self.model is None:
+                logging.info("embeddings: loading model")
+                start = time.time()
+                try:
+                    self.model = self._load()
+                except Exception as e:
+                    self.error = e
+                    raise
+                self.error = None
+                logging.info(f"embeddings: model loaded in {time.time() - start:.2f}s")
+
+        return self.model
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.load().embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.load().embed_query(text)
+
+
+EmbeddingBackend = Literal["inline", "thread", "process"]
+
+T = TypeVar("T")
+
+# Model of an embedding worker process, set by `init_worker`
+worker_model: Embeddings | None = None
+
+
+def init_worker(load: Callable[[], Embeddings]) -> None:
+    global worker_model
+    worker_model = load()
+
+
+def worker_embed(kind: str, texts: list[str]) -> list[list[float]]:
+    assert worker_model is not None, "embedding worker was not initialized"
+    if kind == "query":
+        return embed_queries(worker_model, texts)
+    return worker_model.embed_documents(texts)
+
+
+class EmbeddingExecutor(Embeddings):
+    """
+    Runs embedding inference on a configurable backend:
+
+    - `inline`: in the calling thread, on the event loop for async handlers.
+    - `thread`: in a thread pool, sharing one in-process model.
+    - `process`: in a pool of worker processes, each preloading its own
+      model, so inference does not contend for the GIL with request handling.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[], Embeddings],
+        backend: EmbeddingBackend = "thread",
+        workers: int = 1,
+    ):
+        if backend not in get_args(EmbeddingBackend):
+            raise ValueError(f"Unknown embedding backend: {backend}")
+
+        self._load = load
+        self.backend: EmbeddingBackend = backend
+        self.workers = workers
+        self.model = LazyEmbeddings(load)
+        self.pool: Executor | None = None
+        self.pool_ready = False
+        self.pool_error: Exception | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        if self.backend == "process":
+            return self.pool_ready
+        return self.model.ready
+
+    @property
+    def error(self) -> Exception | None:
+        if self.backend == "process":
+            return self.pool_error
+        return self.model.error
+
+    def get_pool(self) -> Executor:
+        with self._lock:
+            if self.pool is None:
+                if self.backend == "process":
+                    self.pool = ProcessPoolExecutor(
+                        self.workers,
+                        # Forking after torch is imported can deadlock
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=init_worker,
+                        initargs=(self._load,),
+                    )
+                else:
+                    self.pool = ThreadPoolExecutor(
+                        self.workers, thread_name_prefix="embeddings"
+                    )
+            return self.pool
+
+    def load(self) -> None:
+        """Load the model ahead of the first request, in every worker."""
+        if self.backend != "process":
+            self.model.load()
+            return
+
+        try:
+            pool = self.get_pool()
+            for future in [
+                pool.submit(worker_embed, "document", [""]) for _ in range(self.workers)
+            ]:
+                future.result()
+        except Exception as e:
+            self.pool_error = e
+            raise
+        self.pool_ready = True
+        self.pool_error = None
+
+    def embed(self, kind: str, texts: list[str]) -> list[list[float]]:
+        if self.backend == "process":
+            vectors = self.get_pool().submit(worker_embed, kind, texts).result()
+            # Without the warm-up, the first request loads the workers
+            self.pool_ready = True
+            self.pool_error = None
+            return vectors
+        if kind == "query":
+            return embed_queries(self.model, texts)
+        return self.model.embed_documents(texts)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.backend == "thread":
+            return self.get_pool().submit(self.embed, "document", texts).result()
+        return self.embed("document", texts)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        if self.backend == "thread":
+            return self.get_pool().submit(self.embed, "query", texts).result()
+        return self.embed("query", texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_queries([text])[0]
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Run CPU-bound retrieval work (which may embed) from an async handler,
+        off the event loop unless the backend is `inline`.
+        """
+        if self.backend == "inline":
+            return func(*args, **kwargs)
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    def shutdown(self) -> None:
+        """Stop accepting work and wait for in-flight inference to finish."""
+        with self._lock:
+            pool, self.pool = self.pool, None
+            self.pool_ready = False
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+class BatcherStats(BaseModel):
+    batches: int
+    items: int
+    queued: int
+    mean_batch_size: float
+    mean_queue_wait_ms: float
+    max_queue_wait_ms: float
+    mean_inference_ms: float
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces texts embedded by concurrent requests into batched forward
+    passes. A text alone in the queue is flushed right away; otherwise a
+    batch is flushed once it holds `max_batch_size` texts or `max_wait`
+    seconds after its first text arrived, whichever comes first. Texts that
+    `lookup` finds, e.g. in a cache, are not queued at all. Requests are
+    rejected with a 503 once `max_queue` texts are waiting.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[list[str]], list[list[float]]],
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+        max_queue: int = 1024,
+        lookup: Callable[[str], list[float] | None] | None = None,
+    ):
+        self.embed_batch = embed
+        self.lookup = lookup
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.queue: asyncio.Queue[tuple[str, asyncio.Future, float]] | None = None
+        self.worker: asyncio.Task | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+        self.batches = 0
+        self.items = 0
+        self.queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.inference = 0.0
+
+    def start(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if (
+            self.queue is None
+            or self.worker is None
+            or self.worker.done()
+            or self.loop is not loop
+        ):
+            self.loop = loop
+            self.queue = asyncio.Queue(self.max_queue)
+            self.worker = loop.create_task(self.run(self.queue))
+        return self.queue
+
+    async def close(self, timeout: float = 10) -> None:
+        """Embed whatever is still queued, then stop the worker."""
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.error("embeddings: batcher closed with texts still queued")
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.worker = None
+        self.queue = None
+
+    async def embed(self, text: str) -> list[float]:
+        if self.lookup is not None:
+            vector = self.lookup(text)
+            if vector is not None:
+                return vector
+
+        queue = self.start()
+        future: asyncio.Future[list[float]] = asyncio.get_running_loop().create_future()
+        try:
+            queue.put_nowait((text, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Embedding queue is full.")
+        return await future
+
+    async def run(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            # A text alone is flushed right away, waiting only pays off when
+            # others are already arriving
+            deadline = loop.time() + (self.max_wait if not queue.empty() else 0)
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            waits = [start - enqueued for _, _, enqueued in batch]
+            try:
+                vectors = await asyncio.to_thread(
+                    self.embed_batch, [text for text, _, _ in batch]
+                )
+            except Exception as e:
+                logging.error(f"embeddings: batch of {len(batch)} failed: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                    queue.task_done()
+                continue
+
+            for (_, future, _), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+                queue.task_done()
+
+            self.batches += 1
+            self.items += len(batch)
+            self.queue_wait += sum(waits)
+            self.max_queue_wait = max(self.max_queue_wait, *waits)
+            self.inference += time.perf_counter() - start
+
+    def stats(self) -> BatcherStats:
+        return BatcherStats(
+            batches=self.batches,
+            items=self.items,
+            queued=self.queue.qsize() if self.queue is not None else 0,
+            mean_batch_size=self.items / self.batches if self.batches else 0,
+            mean_queue_wait_ms=1000 * self.queue_wait / self.items if self.items else 0,
+            max_queue_wait_ms=1000 * self.max_queue_wait,
+            mean_inference_ms=(
+                1000 * self.inference / self.batches if self.batches else 0
+            ),
+        )
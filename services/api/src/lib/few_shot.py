@@ -1,15 +1,21 @@
 import logging
-from typing import Literal
+import os
+import threading
+from collections import OrderedDict
+from typing import Collection, Literal, cast, get_args
+import numpy as np
+from langchain_core.embeddings import Embeddings
 from langchain_core.prompts import FewShotPromptTemplate, PromptTemplate
-from langchain_core.example_selectors import SemanticSimilarityExampleSelector
 
 # from langchain_openai import OpenAIEmbeddings
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings
-from langchain_core.vectorstores import InMemoryVectorStore
 from pydantic import BaseModel, SecretStr
-import os
 
 from src.lib import xml_utils
+from src.lib.bm25 import BM25Index, reciprocal_rank_fusion
+from src.lib.cache import EMBEDDING_CACHE_SIZE_LIMIT, CachedEmbeddings, open_cache
+from src.lib.embeddings import EmbeddingBackend, EmbeddingBatcher, EmbeddingExecutor
+from src.lib.vectors import StorageType, VectorMatrix, mmr, normalize, top_k
 
 
 class StrippedCritique(BaseModel):
@@ -21,29 +27,551 @@ class StrippedCritique(BaseModel):
 
 
 SimilarityKey = Literal["query", "situation", "context"]
+Retrieval = Literal["dense", "bm25", "hybrid"]
+
+MAX_WARM_INDEXES = int(os.getenv("CRITINO_MAX_WARM_INDEXES", "256"))
+# Environments with at least this many critiques use approximate search
+ANN_THRESHOLD = int(os.getenv("CRITINO_ANN_THRESHOLD", "20000"))
+# Clusters probed per approximate query, higher is slower but more accurate
+ANN_NPROBE = int(os.getenv("CRITINO_ANN_NPROBE", "16"))
+# float32, float16 or int8, compact storage fits more environments in memory
+INDEX_STORAGE = cast(StorageType, os.getenv("CRITINO_INDEX_STORAGE", "float32"))
+# Compact indexes fetch k * RESCORE_FACTOR candidates to rescore exactly
+RESCORE_FACTOR = int(os.getenv("CRITINO_RESCORE_FACTOR", "4"))
+# Hybrid retrieval fuses the top k * HYBRID_FACTOR of each retriever
+HYBRID_FACTOR = int(os.getenv("CRITINO_HYBRID_FACTOR", "4"))
+# Diversity reranking picks k out of the top k * MMR_FETCH_FACTOR by default
+MMR_FETCH_FACTOR = int(os.getenv("CRITINO_MMR_FETCH_FACTOR", "4"))
+# Seconds a warm index is searched before its ids and tags are checked
+# against the database again, and before every row is reread, which picks up
+# critiques edited outside the API
+INDEX_SYNC_INTERVAL = float(os.getenv("CRITINO_INDEX_SYNC_INTERVAL", "5"))
+INDEX_RESYNC_INTERVAL = float(os.getenv("CRITINO_INDEX_RESYNC_INTERVAL", "300"))
 
-embeddings = HuggingFaceBgeEmbeddings(
-    model_name="BAAI/bge-small-en-v1.5",
-    model_kwargs={"device": "cpu"},
-    encode_kwargs={"normalize_embeddings": True},
+EMBEDDING_BACKEND = cast(
+    EmbeddingBackend, os.getenv("CRITINO_EMBEDDING_BACKEND", "thread")
 )
+EMBEDDING_WORKERS = int(os.getenv("CRITINO_EMBEDDING_WORKERS", "1"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("CRITINO_EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("CRITINO_EMBEDDING_BATCH_WAIT_MS", "5"))
+EMBEDDING_QUEUE_DEPTH = int(os.getenv("CRITINO_EMBEDDING_QUEUE_DEPTH", "1024"))
+
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+
+
+def load_model() -> Embeddings:
+    return HuggingFaceBgeEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={"normalize_embeddings": True},
+    )
+
+
+model = EmbeddingExecutor(
+    load_model, backend=EMBEDDING_BACKEND, workers=EMBEDDING_WORKERS
+)
+
+embeddings = CachedEmbeddings(
+    model,
+    model_name=EMBEDDING_MODEL,
+    cache=open_cache("embeddings", size_limit=EMBEDDING_CACHE_SIZE_LIMIT),
+)
+
+# Query embeddings of concurrent requests share forward passes
+batcher = EmbeddingBatcher(
+    embeddings.embed_queries,
+    max_batch_size=EMBEDDING_BATCH_SIZE,
+    max_wait=EMBEDDING_BATCH_WAIT_MS / 1000,
+    max_queue=EMBEDDING_QUEUE_DEPTH,
+    lookup=embeddings.cached_query,
+)
+
+
+def lexical_text(critique: StrippedCritique) -> str:
+    return f"{critique.query}\n{critique.situation}\n{critique.context}"
+
+
+class IndexStats(BaseModel):
+    team_name: str = ""
+    environment_name: str = ""
+    rows: int
+    storage: StorageType
+    bytes: int
+    approximate: bool
+    rescored: int
+    mean_score_error: float
+    max_score_error: float
+
+
+# How much each field counts towards a critique's similarity
+SimilarityWeights = dict[SimilarityKey, float]
+
+
+class CritiqueIndex:
+    """
+    Long-lived index over one environment's critiques, holding a vector per
+    critique for every similarity key. Critiques are only embedded when they
+    are new or when a field's text changed, and not before a dense search
+    needs them when written with `embed=False`. A BM25 index over the query,
+    situation and context is built on the first lexical search and kept up
+    to date from then on. Tags are kept as posting lists, so a tag filter
+    only masks rows of the warm index. Reads and writes hold `lock`, as
+    retrieval runs in worker threads.
+
+    The matrices of the keys always add and remove the same ids in the same
+    order, so a row holds the same critique in each and per-key scores can
+    be blended row by row.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.vectors: dict[SimilarityKey, VectorMatrix] = {
+            similarity_key: VectorMatrix(
+                ann_threshold=ANN_THRESHOLD, nprobe=ANN_NPROBE, storage=INDEX_STORAGE
+            )
+            for similarity_key in get_args(SimilarityKey)
+        }
+        self.critiques: dict[str, StrippedCritique] = {}
+        # Keys whose vector is missing or stale, by critique id in the order
+        # the critiques arrived
+        self.pending: dict[str, set[SimilarityKey]] = {}
+        self.lexical: BM25Index | None = None
+        self.tags: dict[str, list[str]] = {}
+        self.tagged: dict[str, set[str]] = {}
+        self.rescored = 0
+        self.score_error = 0.0
+        self.max_score_error = 0.0
+        # When the index was last checked against the database, and last
+        # reread from it, held by whoever syncs it
+        self.sync_lock = threading.Lock()
+        self.synced_at: float | None = None
+        self.resynced_at: float | None = None
+
+    def __len__(self) -> int:
+        return len(self.critiques)
+
+    @property
+    def rows(self) -> VectorMatrix:
+        """Any of the matrices, they share ids and row order."""
+        return self.vectors["query"]
+
+    def upsert(
+        self,
+        critiques: dict[str, StrippedCritique],
+        embed: bool = True,
+        tags: dict[str, list[str]] | None = None,
+    ) -> None:
+        """`tags` replaces the tags of the critiques it has an entry for."""
+        with self.lock:
+            for id, critique_tags in (tags or {}).items():
+                if id in critiques:
+                    self.tag(id, critique_tags)
+            for id, critique in critiques.items():
+                current = self.critiques.get(id)
+                if current == critique:
+                    continue
+                self.pending.setdefault(id, set()).update(
+                    similarity_key
+                    for similarity_key in get_args(SimilarityKey)
+                    if current is None
+                    or getattr(current, similarity_key)
+                    != getattr(critique, similarity_key)
+                )
+                if self.lexical is not None:
+                    self.lexical.add(id, lexical_text(critique))
+            self.critiques.update(critiques)
+            if embed:
+                self.embed_pending()
+
+    def tag(self, id: str, tags: list[str]) -> None:
+        for tag in self.tags.get(id, []):
+            self.tagged[tag].discard(id)
+            if not self.tagged[tag]:
+                del self.tagged[tag]
+        if tags:
+            self.tags[id] = tags
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(id)
+        else:
+            self.tags.pop(id, None)
+
+    def tagged_with(self, tags: list[str]) -> set[str]:
+        """Ids of the critiques having every tag in `tags`."""
+        with self.lock:
+            postings = sorted(
+                (self.tagged.get(tag, set()) for tag in set(tags)), key=len
+            )
+            return set.intersection(*postings) if postings else set(self.critiques)
+
+    def embed_pending(self) -> None:
+        """Embed the stale fields of every key in one batch."""
+        with self.lock:
+            if not self.pending:
+                return
+
+            logging.info(f"few_shot: embedding {len(self.pending)} critiques")
+            batches = {
+                similarity_key: [
+                    id for id, keys in self.pending.items() if similarity_key in keys
+                ]
+                for similarity_key in get_args(SimilarityKey)
+            }
+            vectors = np.array(
+                embeddings.embed_documents(
+                    [
+                        getattr(self.critiques[id], similarity_key)
+                        for similarity_key, ids in batches.items()
+                        for id in ids
+                    ]
+                ),
+                dtype=np.float32,
+            )
+
+            start = 0
+            for similarity_key, ids in batches.items():
+                self.vectors[similarity_key].upsert(
+                    ids, vectors[start : start + len(ids)]
+                )
+                start += len(ids)
+            self.pending.clear()
+
+    def remove(self, ids: Collection[str]) -> None:
+        with self.lock:
+            ids = [id for id in ids if id in self.critiques]
+            for vectors in self.vectors.values():
+                vectors.remove(ids)
+            for id in ids:
+                del self.critiques[id]
+                self.tag(id, [])
+                self.pending.pop(id, None)
+                if self.lexical is not None:
+                    self.lexical.remove(id)
+
+    def sync(
+        self,
+        critiques: dict[str, StrippedCritique],
+        prune: bool,
+        embed: bool = True,
+        tags: dict[str, list[str]] | None = None,
+    ) -> None:
+        """
+        Bring the index up to date with rows read from the database. With
+        `prune`, `critiques` is the whole environment and anything else is
+        dropped.
+        """
+        with self.lock:
+            self.upsert(critiques, embed=embed, tags=tags)
+            if prune:
+                self.remove([id for id in self.critiques if id not in critiques])
+
+    def missing(self, ids: Collection[str]) -> list[str]:
+        with self.lock:
+            return [id for id in ids if id not in self.critiques]
+
+    def reconcile(
+        self, tags: dict[str, list[str]], critiques: dict[str, StrippedCritique]
+    ) -> None:
+        """
+        Bring the index up to date with the ids and tags of the whole
+        environment, given the critiques it is missing.
+        """
+        with self.lock:
+            self.remove([id for id in self.critiques if id not in tags])
+            self.upsert(critiques, embed=False)
+            for id, critique_tags in tags.items():
+                if id in self.critiques and self.tags.get(id, []) != critique_tags:
+                    self.tag(id, critique_tags)
+
+    def search(
+        self,
+        similarity: str,
+        k: int,
+        weights: SimilarityWeights,
+        ids: Collection[str] | None = None,
+        nprobe: int | None = None,
+        vector: list[float] | None = None,
+        retrieval: Retrieval = "dense",
+        tags: list[str] | None = None,
+        diversity: float | None = None,
+        fetch_k: int | None = None,
+    ) -> list[StrippedCritique]:
+        """
+        Search the critiques in `ids` having all of `tags`. With `diversity`,
+        the top `fetch_k` matches are reranked by maximal marginal relevance
+        down to `k`.
+        """
+        if tags:
+            tagged = self.tagged_with(tags)
+            ids = tagged if ids is None else tagged.intersection(ids)
+
+        wanted = k
+        if diversity is not None:
+            wanted = max(fetch_k or k * MMR_FETCH_FACTOR, k)
+            if vector is None:
+                vector = embeddings.embed_query(similarity)
+
+        if retrieval == "bm25":
+            found = self.search_lexical(similarity, wanted, ids)
+        elif retrieval == "hybrid":
+            found = reciprocal_rank_fusion(
+                [
+                    self.search_dense(
+                        similarity, wanted * HYBRID_FACTOR, weights, ids, nprobe, vector
+                    ),
+                    self.search_lexical(similarity, wanted * HYBRID_FACTOR, ids),
+                ]
+            )[:wanted]
+        else:
+            found = self.search_dense(similarity, wanted, weights, ids, nprobe, vector)
+
+        if diversity is not None and vector is not None:
+            found = self.diversify(found, vector, k, diversity, weights)
+
+        with self.lock:
+            return [self.critiques[id] for id in found]
+
+    def diversify(
+        self,
+        ids: list[str],
+        vector: list[float],
+        k: int,
+        diversity: float,
+        weights: SimilarityWeights,
+    ) -> list[str]:
+        """
+        Rerank candidates with `mmr` over their stored vectors, blended with
+        `weights` like their scores were.
+        """
+        if not ids:
+            return ids
+        with self.lock:
+            self.embed_pending()
+            rows = np.array([self.rows.rows[id] for id in ids])
+            candidates = normalize(
+                np.sum(
+                    [
+                        weight * self.vectors[similarity_key].decode(rows)
+                        for similarity_key, weight in weights.items()
+                    ],
+                    axis=0,
+                )
+            )
+        query = normalize(np.array([vector], dtype=np.float32))[0]
+        return [ids[row] for row in mmr(query, candidates, k, diversity)]
+
+    def search_lexical(
+        self, similarity: str, k: int, ids: Collection[str] | None = None
+    ) -> list[str]:
+        with self.lock:
+            if self.lexical is None:
+                self.lexical = BM25Index()
+                for id, critique in self.critiques.items():
+                    self.lexical.add(id, lexical_text(critique))
+            return [id for id, _ in self.lexical.search(similarity, k, ids)]
+
+    def search_dense(
+        self,
+        similarity: str,
+        k: int,
+        weights: SimilarityWeights,
+        ids: Collection[str] | None = None,
+        nprobe: int | None = None,
+        vector: list[float] | None = None,
+    ) -> list[str]:
+        if vector is None:
+            vector = embeddings.embed_query(similarity)
+        query = normalize(np.array([vector], dtype=np.float32))
+
+        compact = INDEX_STORAGE != "float32"
+        wanted = k * RESCORE_FACTOR if compact else k
+        with self.lock:
+            self.embed_pending()
+            mask = self.rows.mask(ids) if ids is not None else None
+            if len(weights) == 1:
+                (similarity_key,) = weights
+                # One key ranks alike at any weight, its scores are cosines
+                weights = {similarity_key: 1.0}
+                rows, scores = self.vectors[similarity_key].search(
+                    query, wanted, mask=mask, nprobe=nprobe
+                )
+            else:
+                # Rows line up across keys, one weighted sum of the per-key
+                # score vectors scores every critique on every key
+                blended = sum(
+                    weight * self.vectors[similarity_key].score(query)
+                    for similarity_key, weight in weights.items()
+                )
+                assert isinstance(blended, np.ndarray)
+                if mask is not None:
+                    blended[:, ~mask] = -np.inf
+                rows, scores = top_k(blended, wanted)
+
+            found = np.isfinite(scores[0])
+            candidates = [self.rows.ids[row] for row in rows[0][found]]
+            if compact and candidates:
+                candidates = self.rescore(
+                    query[0], candidates, scores[0][found], weights
+                )
+
+            return candidates[:k]
+
+    def rescore(
+        self,
+        query: np.ndarray,
+        ids: list[str],
+        scores: np.ndarray,
+        weights: SimilarityWeights,
+    ) -> list[str]:
+        """
+        Re-rank candidates of a compact index with their full precision
+        vectors, which the embedding cache still holds, and track how far off
+        the compact scores were.
+        """
+        vectors = normalize(
+            np.array(
+                embeddings.embed_documents(
+                    [
+                        getattr(self.critiques[id], similarity_key)
+                        for similarity_key in weights
+                        for id in ids
+                    ]
+                ),
+                dtype=np.float32,
+            )
+        ).reshape(len(weights), len(ids), -1)
+        exact = np.array(list(weights.values()), dtype=np.float32) @ (vectors @ query)
+
+        error = np.abs(exact - scores)
+        self.rescored += len(ids)
+        self.score_error += float(error.sum())
+        self.max_score_error = max(self.max_score_error, float(error.max()))
+
+        return [ids[i] for i in np.argsort(-exact, kind="stable")]
+
+    def stats(self) -> "IndexStats":
+        with self.lock:
+            return IndexStats(
+                rows=len(self.rows),
+                storage=self.rows.storage,
+                bytes=sum(vectors.nbytes for vectors in self.vectors.values()),
+                approximate=self.rows.approximate,
+                rescored=self.rescored,
+                mean_score_error=(
+                    self.score_error / self.rescored if self.rescored else 0
+                ),
+                max_score_error=self.max_score_error,
+            )
+
+
+indexes: OrderedDict[tuple[str, str], CritiqueIndex] = OrderedDict()
+indexes_lock = threading.Lock()
+
+
+def get_index(team_name: str, environment_name: str) -> CritiqueIndex:
+    key = (team_name, environment_name)
+    with indexes_lock:
+        if key in indexes:
+            indexes.move_to_end(key)
+            return indexes[key]
+
+        index = indexes[key] = CritiqueIndex()
+        while len(indexes) > MAX_WARM_INDEXES:
+            evicted, _ = indexes.popitem(last=False)
+            logging.info(f"few_shot: evicted index {evicted}")
+        return index
+
+
+def index_stats() -> list[IndexStats]:
+    """Memory use and compact storage accuracy of every warm index."""
+    with indexes_lock:
+        items = list(indexes.items())
+
+    stats = []
+    for (team_name, environment_name), index in items:
+        stat = index.stats()
+        stat.team_name = team_name
+        stat.environment_name = environment_name
+        stats.append(stat)
+    return stats
+
+
+def update_indexes(
+    team_name: str,
+    environment_name: str,
+    critiques: dict[str, StrippedCritique],
+    tags: dict[str, list[str]] | None = None,
+) -> None:
+    """Apply freshly written critiques to the environment's warm index."""
+    with indexes_lock:
+        index = indexes.get((team_name, environment_name))
+    if index is not None:
+        index.upsert(critiques, tags=tags)
+
+
+def embed_critiques(
+    team_name: str, environment_name: str, critiques: list[StrippedCritique]
+) -> None:
+    """
+    Embed every text the environment's warm index will need for `critiques`
+    in one batch, so that `update_indexes` only reads the cache.
+    """
+    with indexes_lock:
+        if (team_name, environment_name) not in indexes:
+            return
+
+    embeddings.embed_documents(
+        [
+            getattr(critique, similarity_key)
+            for similarity_key in get_args(SimilarityKey)
+            for critique in critiques
+        ]
+    )
 
 
 def find_relevant_critiques(
-    critiques: list[StrippedCritique],
+    critiques: dict[str, StrippedCritique] | None,
     similarity: str,
     k: int = 4,
     similarity_key: SimilarityKey = "query",
+    index: CritiqueIndex | None = None,
+    prune: bool = False,
+    nprobe: int | None = None,
+    vector: list[float] | None = None,
+    retrieval: Retrieval = "dense",
+    tags: list[str] | None = None,
+    critique_tags: dict[str, list[str]] | None = None,
+    similarity_weights: SimilarityWeights | None = None,
+    diversity: float | None = None,
+    fetch_k: int | None = None,
 ) -> list[StrippedCritique]:
-    example_selector = SemanticSimilarityExampleSelector.from_examples(
-        [critique.model_dump() for critique in critiques],
-        embeddings,
-        InMemoryVectorStore,
-        k=k,
-        input_keys=[similarity_key],
-    )
+    """
+    Pass `vector` when `similarity` was already embedded, e.g. through
+    `batcher`, to skip embedding it again. `bm25` retrieval never embeds,
+    unless reranked for `diversity` (0 keeps the relevance order, 1 only
+    avoids near-duplicates). `critique_tags` holds the tags of `critiques`,
+    which `tags` filters on. `similarity_weights` blends several keys
+    instead of `similarity_key`. Without `critiques`, `index` is searched
+    as it is.
+    """
+    index = index if index is not None else CritiqueIndex()
+    if critiques is not None:
+        index.sync(
+            critiques,
+            prune=prune,
+            embed=retrieval != "bm25" or diversity is not None,
+            tags=critique_tags,
+        )
 
-    return [
-        StrippedCritique(**critique)
-        for critique in example_selector.select_examples({similarity_key: similarity})
-    ]
+    return index.search(
+        similarity,
+        k,
+        similarity_weights or {similarity_key: 1.0},
+        # Once pruned the index holds exactly `critiques`
+        ids=None if prune or critiques is None else critiques.keys(),
+        tags=tags,
+        nprobe=nprobe,
+        vector=vector,
+        retrieval=retrieval,
+        diversity=diversity,
+        fetch_k=fetch_k,
+    )
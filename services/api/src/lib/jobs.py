@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Literal
+
+from diskcache import Cache, Deque, Index
+from pydantic import BaseModel
+
+from src.lib.cache import CACHE_DIR
+
+JOB_WORKERS = int(os.getenv("CRITINO_JOB_WORKERS", "2"))
+# Seconds between checks of an empty queue, and of a job streamed over SSE
+JOB_POLL_INTERVAL = float(os.getenv("CRITINO_JOB_POLL_INTERVAL", "0.5"))
+# Seconds finished jobs are kept for clients to read
+JOB_TTL = float(os.getenv("CRITINO_JOB_TTL", "86400"))
+# Seconds between `progress` events of a job, the final one is always sent
+JOB_PROGRESS_INTERVAL = float(os.getenv("CRITINO_JOB_PROGRESS_INTERVAL", "0.5"))
+
+SECRETS_LOST = "The job's secrets were lost in a restart, submit it again."
+
+JobStatus = Literal["queued", "running", "done", "failed"]
+
+
+class JobEvent(BaseModel):
+    event: str
+    data: dict[str, Any]
+
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    team_name: str
+    environment_name: str
+    status: JobStatus = "queued"
+    created_at: float
+    finished_at: float | None = None
+    # Of the process running the job, or holding the secrets of a queued one
+    pid: int | None = None
+    has_secrets: bool = False
+    # Stored apart from the job and loaded when it runs
+    payload: dict[str, Any] = {}
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+
+JobHandler = Callable[[Job, Any], Awaitable[None]]
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    Work queue persisted in a disk cache, so queued jobs survive restarts and
+    are shared by every worker process on the host. Each process runs a few
+    asyncio workers that pop jobs and hand them to the handler registered for
+    their kind. Handlers report with `emit`, or `progress` for throttled
+    progress, which append to the job's event log for `events` to stream.
+
+    A job's record, payload and events are stored apart, so status updates
+    and events only write a few small rows however large the payload and
+    however long the log.
+
+    Secrets a job needs, like API keys, are never written to disk: they stay
+    in the memory of the process that submitted the job, which runs it
+    itself. A job whose secrets were lost in a restart fails.
+    """
+
+    def __init__(self, directory: str):
+        self.queue = Deque(directory=os.path.join(directory, "queue"))
+        # Jobs with secrets, only this process can run them
+        self.local: deque[str] = deque()
+        self.secrets: dict[str, dict[str, Any]] = {}
+        self.jobs = Index(os.path.join(directory, "jobs"))
+        self.payloads = Index(os.path.join(directory, "payloads"))
+        # Event `n` of a job at `(id, n)`, and the job's event count at `id`
+        self.events_log = Cache(os.path.join(directory, "events"))
+        self.handlers: dict[str, JobHandler] = {}
+        self.workers: list[asyncio.Task] = []
+        self.state: Any = None
+        # When each running job of this process last emitted `progress`
+        self.progressed: dict[str, float] = {}
+
+    def handler(self, kind: str) -> Callable[[JobHandler], JobHandler]:
+        """Register the function running jobs of `kind`, with the app state."""
+
+        def register(func: JobHandler) -> JobHandler:
+            self.handlers[kind] = func
+            return func
+
+        return register
+
+    def get(self, id: str) -> Job | None:
+        job = self.jobs.get(id)
+        return Job(**job) if job is not None else None
+
+    def submit(
+        self,
+        kind: str,
+        team_name: str,
+        environment_name: str,
+        payload: dict[str, Any],
+        secrets: dict[str, Any] | None = None,
+    ) -> Job:
+        job = Job(
+            id=str(uuid.uuid4()),
+            kind=kind,
+            team_name=team_name,
+            environment_name=environment_name,
+            created_at=time.time(),
+            pid=os.getpid() if secrets else None,
+            has_secrets=bool(secrets),
+        )
+        self.payloads[job.id] = payload
+        self.jobs[job.id] = job.model_dump(exclude={"payload"})
+        self.emit(job.id, "status", status="queued")
+        if secrets:
+            self.secrets[job.id] = secrets
+            self.local.append(job.id)
+        else:
+            self.queue.append(job.id)
+        return job
+
+    def secret(self, id: str, name: str) -> Any:
+        return self.secrets.get(id, {}).get(name)
+
+    def update(self, id: str, **fields: Any) -> Job:
+        with self.jobs.transact():
+            job = Job(**{**self.jobs[id], **fields})
+            self.jobs[id] = job.model_dump(exclude={"payload"})
+        return job
+
+    def emit(self, id: str, event: str, **data: Any) -> None:
+        with self.events_log.transact():
+            count = self.events_log.incr(id)
+            self.events_log[(id, count - 1)] = JobEvent(
+                event=event, data=data
+            ).model_dump()
+
+    def progress(self, id: str, final: bool, **data: Any) -> None:
+        """Emit a `progress` event, at most every `JOB_PROGRESS_INTERVAL`."""
+        now = time.monotonic()
+        last = self.progressed.get(id)
+        if not final and last is not None and now - last < JOB_PROGRESS_INTERVAL:
+            return
+        self.progressed[id] = now
+        self.emit(id, "progress", **data)
+
+    def log(self, id: str, start: int = 0) -> list[JobEvent]:
+        """The job's events from the `start`th on."""
+        count = self.events_log.get(id, 0)
+        return [JobEvent(**self.events_log[(id, n)]) for n in range(start, count)]
+
+    def finish(self, id: str, status: JobStatus, **data: Any) -> None:
+        self.emit(id, "status", status=status, **data)
+        self.update(id, status=status, finished_at=time.time())
+        self.payloads.pop(id, None)
+        self.progressed.pop(id, None)
+        self.secrets.pop(id, None)
+
+    def drop(self, id: str) -> None:
+        with self.events_log.transact():
+            for n in range(self.events_log.pop(id, 0)):
+                self.events_log.delete((id, n))
+        self.payloads.pop(id, None)
+        self.jobs.pop(id, None)
+
+    def orphaned(self, job: Job) -> bool:
+        """Whether the job was left by a process that is gone."""
+        return job.pid is None or job.pid == os.getpid() or not process_alive(job.pid)
+
+    def recover(self) -> None:
+        """
+        Requeue jobs left running by a process that is gone, fail those
+        whose secrets went with it, and drop finished jobs older than
+        `JOB_TTL`.
+        """
+        now = time.time()
+        for id in list(self.jobs):
+            job = self.get(id)
+            if job is None:
+                continue
+            if job.finished:
+                if job.finished_at is not None and now - job.finished_at > JOB_TTL:
+                    self.drop(id)
+                continue
+            if job.has_secrets and id not in self.secrets and self.orphaned(job):
+                logging.info(f"jobs: failing job {id}, its secrets are gone")
+                self.finish(id, "failed", detail=SECRETS_LOST)
+            elif job.status == "running" and self.orphaned(job):
+                logging.info(f"jobs: requeueing interrupted job {id}")
+                self.update(id, status="queued", pid=None)
+                self.queue.appendleft(id)
+
+    def start(self, state: Any, workers: int = JOB_WORKERS) -> None:
+        self.state = state
+        self.recover()
+        self.workers = [asyncio.create_task(self.work()) for _ in range(workers)]
+
+    async def close(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def next(self) -> str | None:
+        if self.local:
+            return self.local.popleft()
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            return None
+
+    async def work(self) -> None:
+        while True:
+            id = self.next()
+            if id is None:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            job = self.get(id)
+            if job is None or job.finished:
+                continue
+            await self.run(job)
+
+    async def run(self, job: Job) -> None:
+        handler = self.handlers.get(job.kind)
+        if handler is None:
+            self.finish(job.id, "failed", detail=f"Unknown job kind: {job.kind}")
+            return
+        if job.has_secrets and job.id not in self.secrets:
+            self.finish(job.id, "failed", detail=SECRETS_LOST)
+            return
+
+        job = self.update(job.id, status="running", pid=os.getpid())
+        job.payload = self.payloads.get(job.id, {})
+        self.emit(job.id, "status", status="running")
+        logging.info(f"jobs: running {job.kind} job {job.id}")
+        try:
+            await handler(job, self.state)
+        except asyncio.CancelledError:
+            # Shutting down, the next start picks the job up again
+            self.progressed.pop(job.id, None)
+            self.update(job.id, status="queued", pid=None)
+            self.queue.appendleft(job.id)
+            raise
+        except Exception as e:
+            logging.error(f"jobs: {job.kind} job {job.id} failed: {e!r}")
+            detail = getattr(e, "detail", None) or str(e)
+            self.finish(job.id, "failed", detail=detail)
+            return
+        self.finish(job.id, "done")
+
+    async def events(self, id: str) -> AsyncIterator[JobEvent]:
+        """Yield the job's events as they are emitted, until it finishes."""
+        sent = 0
+        while True:
+            job = self.get(id)
+            if job is None:
+                return
+            # Read after the job: a finished job has emitted its last event
+            events = self.log(id, sent)
+            for event in events:
+                yield event
+            sent += len(events)
+            if job.finished:
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+queue = JobQueue(os.path.join(CACHE_DIR, "jobs"))
@@ -0,0 +1,314 @@
+from typing import Collection, Literal, get_args
+
+import numpy as np
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Select the `k` best columns of every row of a (queries, n) score matrix,
+    best first. `argpartition` keeps this linear in `n`; only the `k` winners
+    get sorted.
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.intp), empty.astype(np.float32)
+
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+
+    return (
+        np.take_along_axis(candidates, order, axis=1),
+        np.take_along_axis(candidate_scores, order, axis=1),
+    )
+
+
+def mmr(
+    query: np.ndarray, candidates: np.ndarray, k: int, diversity: float
+) -> np.ndarray:
+    """
+    Maximal marginal relevance: pick `k` of the unit `candidates` one at a
+    time, each maximizing `(1 - diversity) * relevance - diversity *
+    redundancy`, where redundancy is its highest similarity to a candidate
+    already picked. Pairwise similarities are one matrix product up front and
+    each pick only updates a running maximum, so the Python loop runs `k`
+    times over NumPy vectors. Returns the picked rows in order.
+    """
+    k = min(k, len(candidates))
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    picked = np.empty(k, dtype=np.intp)
+    redundancy = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    for i in range(k):
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        scores[~available] = -np.inf
+        picked[i] = np.argmax(scores)
+        available[picked[i]] = False
+        redundancy = (
+            similarity[picked[i]]
+            if i == 0
+            else np.maximum(redundancy, similarity[picked[i]])
+        )
+    return picked
+
+
+def kmeans(
+    vectors: np.ndarray, clusters: int, iterations: int = 8, seed: int = 0
+) -> np.ndarray:
+    """
+    Spherical k-means: unit-length centroids assigned by inner product, which
+    matches the cosine scoring used for search.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        filled = np.bincount(assignments, minlength=clusters) > 0
+        centroids[filled] = normalize(sums[filled])
+    return centroids
+
+
+StorageType = Literal["float32", "float16", "int8"]
+
+# Rows converted to float32 at a time when scoring a compact matrix, bounds
+# the temporary memory of a search
+SCORE_CHUNK_ROWS = 4096
+
+
+class VectorMatrix:
+    """
+    Unit vectors stored row-wise in one contiguous matrix, addressed by
+    string ids. Capacity grows geometrically so upserts are amortized O(1)
+    and removal swaps the last row into the hole.
+
+    `storage` trades precision for memory: `float16` halves it and `int8`
+    (scalar quantization with one float32 scale per row) quarters it. Scores
+    from compact storage are approximate; callers that need exact ranking
+    should rescore the best candidates at full precision.
+
+    At `ann_threshold` rows and above, searches go through an inverted file
+    (IVF) index: rows are clustered around ~sqrt(n) centroids and a query
+    only scores the rows of its `nprobe` closest clusters. Higher `nprobe`
+    trades speed for recall. The clustering is retrained whenever the matrix
+    has doubled or halved since the last training.
+    """
+
+    def __init__(
+        self,
+        ann_threshold: int | None = None,
+        nprobe: int = 16,
+        storage: StorageType = "float32",
+    ) -> None:
+        if storage not in get_args(StorageType):
+            raise ValueError(f"Unknown vector storage type: {storage}")
+
+        self.ids: list[str] = []
+        self.rows: dict[str, int] = {}
+        self.storage: StorageType = storage
+        self.data = np.empty((0, 0), dtype=storage)
+        self.scales = np.empty(0, dtype=np.float32)
+        self.ann_threshold = ann_threshold
+        self.nprobe = nprobe
+        self.centroids: np.ndarray | None = None
+        self.lists = np.empty(0, dtype=np.int32)
+        self.trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.decode(slice(0, len(self.ids)))
+
+    @property
+    def nbytes(self) -> int:
+        count = len(self.ids)
+        return (
+            self.data[:count].nbytes
+            + (self.scales[:count].nbytes if self.storage == "int8" else 0)
+            + self.lists[:count].nbytes
+            + (self.centroids.nbytes if self.centroids is not None else 0)
+        )
+
+    @property
+    def approximate(self) -> bool:
+        return self.ann_threshold is not None and len(self) >= self.ann_threshold
+
+    def encode(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        if self.storage != "int8":
+            return vectors.astype(self.storage), np.ones(len(vectors), np.float32)
+
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return (
+            np.round(vectors / scales[:, None]).astype(np.int8),
+            scales.astype(np.float32),
+        )
+
+    def decode(self, rows: slice | np.ndarray) -> np.ndarray:
+        vectors = self.data[rows].astype(np.float32)
+        if self.storage == "int8":
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def score(self, queries: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """Inner products of `queries` with `rows` (default: every row)."""
+        if self.storage == "float32":
+            vectors = self.data[: len(self)] if rows is None else self.data[rows]
+            return queries @ vectors.T
+
+        rows = np.arange(len(self)) if rows is None else rows
+        scores = np.empty((len(queries), len(rows)), dtype=np.float32)
+        for start in range(0, len(rows), SCORE_CHUNK_ROWS):
+            chunk = rows[start : start + SCORE_CHUNK_ROWS]
+            scores[:, start : start + len(chunk)] = queries @ self.decode(chunk).T
+        return scores
+
+    def reserve(self, count: int, dimensions: int) -> None:
+        if self.data.shape[1] not in (0, dimensions):
+            raise ValueError(
+                f"expected {self.data.shape[1]}-dimensional vectors, got {dimensions}"
+            )
+        if count <= self.data.shape[0] and self.data.shape[1] == dimensions:
+            return
+
+        capacity = max(count, 2 * self.data.shape[0], 16)
+        data = np.empty((capacity, dimensions), dtype=self.storage)
+        scales = np.ones(capacity, dtype=np.float32)
+        lists = np.zeros(capacity, dtype=np.int32)
+        if self.ids:
+            data[: len(self.ids)] = self.data[: len(self.ids)]
+            scales[: len(self.ids)] = self.scales[: len(self.ids)]
+            lists[: len(self.ids)] = self.lists[: len(self.ids)]
+        self.data = data
+        self.scales = scales
+        self.lists = lists
+
+    def upsert(self, ids: list[str], vectors: np.ndarray) -> None:
+        if not ids:
+            return
+
+        vectors = normalize(vectors)
+        new = [id for id in dict.fromkeys(ids) if id not in self.rows]
+        self.reserve(len(self.ids) + len(new), vectors.shape[1])
+        for id in new:
+            self.rows[id] = len(self.ids)
+            self.ids.append(id)
+
+        rows = [self.rows[id] for id in ids]
+        self.data[rows], self.scales[rows] = self.encode(vectors)
+        if self.centroids is not None:
+            self.lists[rows] = np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def remove(self, ids: Collection[str]) -> None:
+        for id in ids:
+            row = self.rows.pop(id, None)
+            if row is None:
+                continue
+
+            last = self.ids.pop()
+            if row < len(self.ids):
+                self.data[row] = self.data[len(self.ids)]
+                self.scales[row] = self.scales[len(self.ids)]
+                self.lists[row] = self.lists[len(self.ids)]
+                self.ids[row] = last
+                self.rows[last] = row
+
+    def mask(self, ids: Collection[str]) -> np.ndarray:
+        mask = np.zeros(len(self.ids), dtype=bool)
+        mask[[self.rows[id] for id in ids if id in self.rows]] = True
+        return mask
+
+    def train(self) -> None:
+        clusters = max(1, int(np.sqrt(len(self))))
+        rng = np.random.default_rng(0)
+        sample = self.decode(
+            np.sort(rng.choice(len(self), min(len(self), 64 * clusters), replace=False))
+        )
+        self.centroids = kmeans(sample, clusters)
+        self.lists[: len(self)] = np.argmax(self.score(self.centroids), axis=0)
+        self.trained_size = len(self)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        mask: np.ndarray | None = None,
+        nprobe: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Score a batch of query vectors and return the top `k` (rows, scores)
+        per query. Rows outside `mask` are excluded and trailing slots that
+        could not be filled have a score of -inf.
+        """
+        queries = normalize(queries)
+        if not self.ids:
+            return top_k(np.empty((len(queries), 0), dtype=np.float32), k)
+
+        if self.approximate:
+            rows, scores = self.search_approximate(
+                queries, k, mask, nprobe if nprobe is not None else self.nprobe
+            )
+            # A narrow mask can leave the probed clusters short of k matches
+            wanted = min(k, len(self) if mask is None else int(mask.sum()))
+            if scores.shape[1] >= wanted and np.isfinite(scores[:, :wanted]).all():
+                return rows, scores
+
+        return self.search_exact(queries, k, mask)
+
+    def search_exact(
+        self, queries: np.ndarray, k: int, mask: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Brute force: one matrix product over every row."""
+        scores = self.score(queries)
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+        return top_k(scores, k)
+
+    def search_approximate(
+        self, queries: np.ndarray, k: int, mask: np.ndarray | None, nprobe: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if (
+            self.centroids is None
+            or len(self) > 2 * self.trained_size
+            or 2 * len(self) < self.trained_size
+        ):
+            self.train()
+        assert self.centroids is not None
+
+        nprobe = min(max(nprobe, 1), len(self.centroids))
+        probed, _ = top_k(queries @ self.centroids.T, nprobe)
+
+        # Score the union of probed rows across the batch in one product,
+        # then hide from each query the rows outside its own clusters
+        lists = self.lists[: len(self)]
+        candidates = np.flatnonzero(np.isin(lists, probed))
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        if 2 * len(candidates) > len(self):
+            # Large batches probe most clusters anyway, skip the bookkeeping
+            return self.search_exact(queries, k, mask)
+
+        scores = self.score(queries, candidates)
+        probed_by_query = (lists[candidates][None, :, None] == probed[:, None, :]).any(
+            axis=2
+        )
+        scores[~probed_by_query] = -np.inf
+
+        rows, scores = top_k(scores, k)
+        return candidates[rows], scores
@@ -2,6 +2,7 @@ import urllib.parse
 from typing import Annotated
 from pydantic import AfterValidator, BaseModel
 from src.interfaces import db
+from supabase import Client
 
 from fastapi import APIRouter, Depends, Header
 from src.lib import auth
@@ -19,9 +20,8 @@ class GetAuthResponse(BaseModel):
 async def authenticate_team(
     name: Annotated[str, AfterValidator(vd.str_empty)],
     x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> GetAuthResponse:
-    supabase = db.client()
-
     auth.authenticate_team(supabase, name, x_critino_key)
     return GetAuthResponse(status=200, detail="Authorized.")
 
@@ -36,6 +36,7 @@ async def authenticate_environment(
     name: Annotated[str, AfterValidator(vd.str_empty)],
     query: Annotated[GetEnvironmentQuery, Depends(GetEnvironmentQuery)],
     x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> GetAuthResponse:
 
     query.team_name = urllib.parse.unquote(query.team_name)
@@ -46,8 +47,6 @@ async def authenticate_environment(
         if query.parent_name not in name:
             name = f"{query.parent_name}/{name}"
 
-    supabase = db.client()
-
     auth.authenticate_team_or_environment(
         supabase, query.team_name, name, x_critino_key
     )
@@ -1,29 +1,50 @@
+import asyncio
+import base64
+import json
+import os
 import traceback
 import logging
+import math
+import time
 from functools import wraps
-from typing import Annotated, cast
+from typing import Annotated, Any, AsyncIterator, Callable, Iterator, cast, get_args
 import urllib.parse
 import uuid
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from pydantic import BaseModel, AfterValidator, Field
+from pydantic import BaseModel, AfterValidator, Field, ValidationError
 from src.interfaces import db, llm
 from src.lib.url_utils import get_url, sluggify
-from supabase import PostgrestAPIError
+from supabase import Client, PostgrestAPIError
 
-from fastapi import APIRouter, Depends, HTTPException, Header, Query
-from src.lib import auth, validators as vd
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from src.lib import auth, jobs, validators as vd
+from src.lib.cache import hash_text, situations
 
 
+from src.lib import few_shot
 from src.lib.few_shot import (
+    Retrieval,
     SimilarityKey,
+    SimilarityWeights,
     find_relevant_critiques,
     StrippedCritique,
 )
 
 router = APIRouter(prefix="/critiques")
 
+# Rows written per upsert by `upsert_many`
+UPSERT_BATCH_SIZE = int(os.getenv("CRITINO_UPSERT_BATCH_SIZE", "500"))
+# Rows written per upsert by imports
+IMPORT_BATCH_SIZE = int(os.getenv("CRITINO_IMPORT_BATCH_SIZE", "500"))
+# Longer import lines are rejected instead of buffered
+IMPORT_MAX_LINE_BYTES = int(
+    os.getenv("CRITINO_IMPORT_MAX_LINE_BYTES", str(4 * 1024**2))
+)
+
 
 def handle_error(func):
     @wraps(func)
@@ -61,7 +82,18 @@ def ahandle_error(func):
     return wrapper
 
 
-def generate_situation(model: ChatOpenAI, context: str) -> str:
+def strip_critique(critique: dict) -> StrippedCritique:
+    return StrippedCritique(
+        optimal=critique["optimal"] or "",
+        instructions=critique["instructions"] or "",
+        query=critique["query"],
+        # Not set yet on rows about to be written without a model
+        context=critique.get("context") or "",
+        situation=critique.get("situation") or "",
+    )
+
+
+async def agenerate_situation(model: ChatOpenAI, context: str) -> str:
     class Situation(BaseModel):
         situation: str = Field(
             description="A ~10 word description of the situation from the context and query. The situation should be generic such that it's similarly worded to others since it's used for similarity search."
@@ -69,6 +101,12 @@ def generate_situation(model: ChatOpenAI, context: str) -> str:
 
     context = truncate_context(context)
 
+    key = f"{model.model_name}:{hash_text(context)}"
+    cached = situations.get(key)
+    if cached is not None:
+        logging.info(f"critiques: generate_situation: cached: {cached}")
+        return cached
+
     prompt = ChatPromptTemplate(
         [
             HumanMessage(
@@ -87,17 +125,186 @@ Please deduce the situation from the context provided.
 
     situation = cast(
         Situation,
-        agent.invoke(prompt.invoke({})),
+        await agent.ainvoke(prompt.invoke({})),
     ).situation
 
     logging.info(f"critiques: generate_situation: {situation}")
+    situations.set(key, situation)
 
     return situation
 
 
+# Columns a listing can be projected to, `id`, `created_at` and `tags` on top
+# of the critique itself
+CRITIQUE_FIELDS = ["id", "created_at", "tags", *StrippedCritique.model_fields]
+# At most PostgREST's `max_rows` (web/supabase/config.toml), or a full page
+# would come back short and end `iter_critiques` early
+MAX_PAGE_SIZE = 1000
+# Columns a warm index is built from
+INDEX_COLUMNS = ",".join(["id", "created_at", "tags", *StrippedCritique.model_fields])
+# Ids per `in` filter when fetching the rows an index lacks, they go in the URL
+ID_BATCH_SIZE = 100
+
+
+def encode_cursor(critique: dict) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([critique["created_at"], critique["id"]]).encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid 'cursor'.")
+    # Both end up quoted in a PostgREST filter
+    if not all(
+        isinstance(value, str) and '"' not in value for value in (created_at, id)
+    ):
+        raise HTTPException(status_code=400, detail="Invalid 'cursor'.")
+    return created_at, id
+
+
+def keyset_filter(created_at: str, id: str) -> str:
+    """PostgREST filter for the rows ordered after (created_at, id)."""
+    return (
+        f'created_at.gt."{created_at}",'
+        f'and(created_at.eq."{created_at}",id.gt."{id}")'
+    )
+
+
+def iter_critiques(
+    supabase: Client,
+    team_name: str,
+    environment_names: list[str],
+    columns: str = "*",
+    tags: list[str] | None = None,
+    page_size: int = MAX_PAGE_SIZE,
+) -> Iterator[dict]:
+    """
+    Yield every critique of the environments one keyset page at a time, so
+    only a single page is ever held in memory. `columns` must include `id`
+    and `created_at`.
+    """
+    after: tuple[str, str] | None = None
+    while True:
+        request = (
+            supabase.table("critiques")
+            .select(columns)
+            .eq("team_name", team_name)
+            .in_("environment_name", environment_names)
+        )
+        if tags:
+            request = request.contains("tags", tags)
+        if after is not None:
+            request = request.or_(keyset_filter(*after))
+        rows = request.order("created_at").order("id").limit(page_size).execute().data
+
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1]["created_at"], rows[-1]["id"]
+
+
+def sync_index(
+    supabase: Client,
+    team_name: str,
+    environment_name: str,
+    index: few_shot.CritiqueIndex,
+) -> None:
+    """
+    Bring a warm index up to date before a search. Writes through the API
+    already reach it through `update_indexes`, so only ids and tags are
+    checked every INDEX_SYNC_INTERVAL seconds, fetching the rows it lacks,
+    and every row is reread every INDEX_RESYNC_INTERVAL seconds.
+    """
+    with index.sync_lock:
+        now = time.monotonic()
+        if (
+            index.resynced_at is None
+            or now - index.resynced_at >= few_shot.INDEX_RESYNC_INTERVAL
+        ):
+            critiques: dict[str, StrippedCritique] = {}
+            critique_tags: dict[str, list[str]] = {}
+            for critique in iter_critiques(
+                supabase, team_name, [environment_name], INDEX_COLUMNS
+            ):
+                critiques[critique["id"]] = strip_critique(critique)
+                critique_tags[critique["id"]] = critique["tags"]
+            index.sync(critiques, prune=True, embed=False, tags=critique_tags)
+            index.synced_at = index.resynced_at = now
+        elif (
+            index.synced_at is None
+            or now - index.synced_at >= few_shot.INDEX_SYNC_INTERVAL
+        ):
+            critique_tags = {
+                critique["id"]: critique["tags"]
+                for critique in iter_critiques(
+                    supabase, team_name, [environment_name], "id,created_at,tags"
+                )
+            }
+            missing = index.missing(critique_tags)
+            critiques = {}
+            for start in range(0, len(missing), ID_BATCH_SIZE):
+                response = (
+                    supabase.table("critiques")
+                    .select(INDEX_COLUMNS)
+                    .eq("team_name", team_name)
+                    .eq("environment_name", environment_name)
+                    .in_("id", missing[start : start + ID_BATCH_SIZE])
+                    .execute()
+                )
+                for critique in response.data:
+                    critiques[critique["id"]] = strip_critique(critique)
+            index.reconcile(critique_tags, critiques)
+            index.synced_at = now
+
+
+def chat_model(api_key: str | None) -> ChatOpenAI | None:
+    return (
+        llm.chat_open_router(
+            model="anthropic/claude-3-5-haiku-20241022:beta",
+            api_key=api_key,
+            temperature=0.1,
+        )
+        if api_key
+        else None
+    )
+
+
+def parse_similarity_weights(value: str) -> SimilarityWeights:
+    weights: SimilarityWeights = {}
+    try:
+        for pair in value.split(","):
+            similarity_key, weight = pair.split(":")
+            similarity_key = similarity_key.strip()
+            if similarity_key not in get_args(SimilarityKey):
+                raise ValueError(similarity_key)
+            if similarity_key in weights:
+                raise ValueError(f"repeated {similarity_key}")
+            number = float(weight)
+            if not math.isfinite(number) or number <= 0:
+                raise ValueError(weight)
+            weights[cast(SimilarityKey, similarity_key)] = number
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"'similarity_weights' must look like 'query:0.6,context:0.4' with distinct keys among {', '.join(get_args(SimilarityKey))} and positive weights.",
+        )
+    return weights
+
+
+def project_critique(critique: dict, fields: list[str]) -> dict[str, Any]:
+    return {
+        field: critique[field] if critique[field] is not None else ""
+        for field in fields
+    }
+
+
 @router.get("/ids")
-def get_critique_ids() -> list[str]:
-    supabase = db.client()
+def get_critique_ids(
+    supabase: Annotated[Client, Depends(db.get_client)],
+) -> list[str]:
     response = supabase.table("critiques").select("id").execute()
     return [critique["id"] for critique in response.data]
 
@@ -109,12 +316,23 @@ class GetCritiquesQuery(BaseModel):
     query: str | None = None
     k: int | None = None
     similarity_key: SimilarityKey = "query"
+    # e.g. `query:0.6,context:0.4`, blends keys instead of `similarity_key`
+    similarity_weights: str | None = None
+    nprobe: int | None = None
+    retrieval: Retrieval = "dense"
+    # Maximal marginal relevance rerank of the top `fetch_k` down to `k`,
+    # from 0 (relevance only) to 1 (novelty only)
+    diversity: float | None = None
+    fetch_k: int | None = None
+    limit: int | None = None
+    cursor: str | None = None
 
 
 class GetCritiquesResult(BaseModel):
     situation: str | None = None
-    data: list[StrippedCritique]
+    data: list[StrippedCritique] | list[dict[str, Any]]
     count: int
+    next_cursor: str | None = None
 
 
 @router.get("")
@@ -123,7 +341,9 @@ async def list_critiques(
     x_critino_key: Annotated[str, Header()],
     query: Annotated[GetCritiquesQuery, Depends(GetCritiquesQuery)],
     x_openrouter_api_key: Annotated[str | None, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
     tags: Annotated[list[str] | None, Query()] = None,
+    fields: Annotated[list[str] | None, Query()] = None,
 ) -> GetCritiquesResult:
     logging.info(f"list_critiques: x_critino_key: {x_critino_key} - params: {query}")
 
@@ -137,60 +357,94 @@ async def list_critiques(
             status_code=400,
             detail="Both 'query' and 'k' must be either set if you want relevant critiques or None if you want all critiques.",
         )
+    paged = query.limit is not None or query.cursor is not None
+    if (paged or fields) and query.query is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="'limit', 'cursor' and 'fields' can only be used when listing all critiques.",
+        )
+    if query.limit is not None and not 1 <= query.limit <= MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"'limit' must be between 1 and {MAX_PAGE_SIZE}.",
+        )
+    if fields and not set(fields) <= set(CRITIQUE_FIELDS):
+        raise HTTPException(
+            status_code=400,
+            detail=f"'fields' must be a subset of {', '.join(CRITIQUE_FIELDS)}.",
+        )
+    if query.diversity is not None and not 0 <= query.diversity <= 1:
+        raise HTTPException(
+            status_code=400,
+            detail="'diversity' must be between 0 and 1.",
+        )
+    if query.fetch_k is not None and (
+        query.diversity is None or query.k is None or query.fetch_k < query.k
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="'fetch_k' must be at least 'k' and can only be used with 'diversity'.",
+        )
 
-    supabase = db.client()
+    # Blended keys all compare against the query, no situation is generated
+    similarity_weights = (
+        parse_similarity_weights(query.similarity_weights)
+        if query.similarity_weights
+        else None
+    )
 
     auth.authenticate_team_or_environment(
         supabase, query.team_name, query.environment_name, x_critino_key
     )
 
-    request = (
-        supabase.table("critiques")
-        .select("*")
-        .eq("team_name", query.team_name)
-        .eq("environment_name", query.environment_name)
+    # Only the columns the response needs, never `response`. `fields` can
+    # leave out `context`, the largest one; stripped critiques and searches,
+    # which embed and match on it, always read it
+    columns = (
+        list(dict.fromkeys(["id", "created_at", *fields]))
+        if fields
+        else ["id", "created_at", *StrippedCritique.model_fields]
     )
-    if tags:
-        request = request.contains("tags", tags)
-
-    response = request.execute()
-
     if query.query is None or query.k is None:
+        request = (
+            supabase.table("critiques")
+            .select(",".join(columns))
+            .eq("team_name", query.team_name)
+            .eq("environment_name", query.environment_name)
+        )
+        if tags:
+            request = request.contains("tags", tags)
+        # Keyset pagination, each page starts right after the last row of the
+        # previous one so deep pages cost the same as the first. A listing
+        # without `limit` is still a page, PostgREST caps every read at
+        # `max_rows`, and says so through `next_cursor`
+        if query.cursor is not None:
+            created_at, id = decode_cursor(query.cursor)
+            request = request.or_(keyset_filter(created_at, id))
+        limit = query.limit or MAX_PAGE_SIZE
+        response = request.order("created_at").order("id").limit(limit).execute()
+        next_cursor = (
+            encode_cursor(response.data[-1]) if len(response.data) == limit else None
+        )
         return GetCritiquesResult(
-            data=[
-                StrippedCritique(
-                    optimal=critique["optimal"] if not None else "",
-                    instructions=critique["instructions"] if not None else "",
-                    query=critique["query"],
-                    context=critique["context"],
-                    situation=critique["situation"],
-                )
-                for critique in response.data
-            ],
+            data=(
+                [project_critique(critique, fields) for critique in response.data]
+                if fields
+                else [strip_critique(critique) for critique in response.data]
+            ),
             count=len(response.data),
+            next_cursor=next_cursor,
         )
 
-    critiques = [
-        StrippedCritique(
-            optimal=critique["optimal"] if not None else "",
-            instructions=critique["instructions"] if not None else "",
-            query=critique["query"],
-            context=critique["context"],
-            situation=critique["situation"],
-        )
-        for critique in response.data
-    ]
+    # Searches run on the environment's warm index, which holds every
+    # critique and filters tags itself so every tag combination shares it
+    index = few_shot.get_index(query.team_name, query.environment_name)
+    await asyncio.to_thread(
+        sync_index, supabase, query.team_name, query.environment_name, index
+    )
 
-    if query.similarity_key == "situation":
-        model = (
-            llm.chat_open_router(
-                model="anthropic/claude-3-5-haiku-20241022:beta",
-                api_key=x_openrouter_api_key,
-                temperature=0.1,
-            )
-            if x_openrouter_api_key
-            else None
-        )
+    if query.similarity_key == "situation" and similarity_weights is None:
+        model = chat_model(x_openrouter_api_key)
 
         if not model:
             raise HTTPException(
@@ -200,24 +454,126 @@ async def list_critiques(
 
         context = query.context + "\n" if query.context else "" + query.query
         logging.info(f"generate_fields: Generated context: {context}")
-        situation = generate_situation(model, context)
+        try:
+            situation = await llm.run_limited(
+                query.team_name, lambda: agenerate_situation(model, context)
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=504, detail="Timed out generating the situation."
+            )
         logging.info(f"generate_fields: Generated situation: {situation}")
 
-        relevant_critiques = find_relevant_critiques(
-            critiques, situation, k=query.k, similarity_key=query.similarity_key
+        relevant_critiques = await few_shot.model.run(
+            find_relevant_critiques,
+            None,
+            situation,
+            k=query.k,
+            similarity_key=query.similarity_key,
+            index=index,
+            nprobe=query.nprobe,
+            vector=(
+                await few_shot.batcher.embed(situation)
+                if query.retrieval != "bm25" or query.diversity is not None
+                else None
+            ),
+            retrieval=query.retrieval,
+            diversity=query.diversity,
+            fetch_k=query.fetch_k,
+            tags=tags,
         )
 
         return GetCritiquesResult(
             situation=situation, data=relevant_critiques, count=len(relevant_critiques)
         )
 
-    relevant_critiques = find_relevant_critiques(
-        critiques, query.query, k=query.k, similarity_key=query.similarity_key
+    relevant_critiques = await few_shot.model.run(
+        find_relevant_critiques,
+        None,
+        query.query,
+        k=query.k,
+        similarity_key=query.similarity_key,
+        similarity_weights=similarity_weights,
+        index=index,
+        nprobe=query.nprobe,
+        vector=(
+            await few_shot.batcher.embed(query.query)
+            if query.retrieval != "bm25" or query.diversity is not None
+            else None
+        ),
+        retrieval=query.retrieval,
+        diversity=query.diversity,
+        fetch_k=query.fetch_k,
+        tags=tags,
     )
 
     return GetCritiquesResult(data=relevant_critiques, count=len(relevant_critiques))
 
 
+class GetCritiquesExportQuery(BaseModel):
+    team_name: str
+    environment_name: str
+    descendants: bool = False
+
+
+@router.get("/export")
+@handle_error
+def export_critiques(
+    x_critino_key: Annotated[str, Header()],
+    query: Annotated[GetCritiquesExportQuery, Depends(GetCritiquesExportQuery)],
+    supabase: Annotated[Client, Depends(db.get_client)],
+    tags: Annotated[list[str] | None, Query()] = None,
+) -> StreamingResponse:
+    """
+    Stream the environment's critiques, and with `descendants` those of every
+    environment nested under it, as newline-delimited JSON.
+    """
+    logging.info(f"export_critiques: x_critino_key: {x_critino_key} - params: {query}")
+
+    query.team_name = urllib.parse.unquote(query.team_name).strip()
+    query.environment_name = urllib.parse.unquote(query.environment_name).strip()
+
+    auth.authenticate_team_or_environment(
+        supabase, query.team_name, query.environment_name, x_critino_key
+    )
+
+    environment_names = [query.environment_name]
+    if query.descendants:
+        try:
+            response = (
+                supabase.table("environments")
+                .select("name")
+                .eq("team_name", query.team_name)
+                .like("name", f"{query.environment_name}/*")
+                .execute()
+            )
+        except PostgrestAPIError as e:
+            logging.error(f"PostgrestAPIError: {e}")
+            raise HTTPException(status_code=500, detail={**e.json()})
+        # `like` treats `%` and `_` in names as wildcards, keep exact matches
+        environment_names += [
+            environment["name"]
+            for environment in response.data
+            if environment["name"].startswith(f"{query.environment_name}/")
+        ]
+
+    def lines() -> Iterator[str]:
+        count = 0
+        try:
+            for critique in iter_critiques(
+                supabase, query.team_name, environment_names, tags=tags
+            ):
+                count += 1
+                yield json.dumps(critique) + "\n"
+        except Exception as e:
+            # Headers are already sent, all that is left is to cut the stream
+            logging.error(f"export_critiques: failed after {count} critiques: {e}")
+            raise
+        logging.info(f"export_critiques: exported {count} critiques")
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 class PostCritiquesQuery(BaseModel):
     team_name: Annotated[str, AfterValidator(vd.str_empty)]
     environment_name: Annotated[str, AfterValidator(vd.str_empty)]
@@ -247,12 +603,12 @@ def truncate_context(context: str, limit: int = 1500) -> str:
     return context
 
 
-def generate_fields(
+async def agenerate_fields(
     query: PostCritiquesQuery,
     body: PostCritiquesBody,
     model: ChatOpenAI,
     attempts: int = 3,
-    messages: list[BaseMessage] = [],
+    messages: list[BaseMessage] | None = None,
 ) -> FilledBody:
     logging.info(
         f"generate_fields: Starting to generate fields for query: {query}, body: {body}"
@@ -260,7 +616,7 @@ def generate_fields(
     context = (body.context + "\n" if body.context else "") + (
         body.query if body.query else ""
     )
-    situation = generate_situation(model, context)
+    situation = await agenerate_situation(model, context)
     filled_body = FilledBody(
         query=body.query,
         context=body.context,
@@ -276,6 +632,9 @@ def generate_fields(
         logging.info("critiques: generate_fields: did not populate fields")
         return filled_body
 
+    # Fresh per call, generations for a batch run concurrently
+    messages = [] if messages is None else messages
+
     class Populate(BaseModel):
         chain_of_thought: str = Field(
             description="This is your reasoning, use it to evaluate the current information given. Especially the context and original response 'response'. Evaluate how the response was optimized 'optimal'. Then make sure to evaluate how to create instructions on how to achieve the 'optimal' answer. Always start this field with `Let's think step by step. `"
@@ -317,7 +676,7 @@ If optimal is present, that is the **optimal** you're aiming for.
         logging.info(f"generate_fields: Attempt {attempt + 1}")
         result = cast(
             Populate,
-            agent.invoke(prompt.invoke({"msgs": messages})),
+            await agent.ainvoke(prompt.invoke({"msgs": messages})),
         )
         logging.info(f"generate_fields: Result from agent: {result}")
         if (
@@ -378,6 +737,217 @@ If optimal is present, that is the **optimal** you're aiming for.
     return filled_body
 
 
+class PostCritiquesImportQuery(BaseModel):
+    team_name: Annotated[str, AfterValidator(vd.str_empty)]
+    environment_name: Annotated[str, AfterValidator(vd.str_empty)]
+
+
+class ImportCritique(PostCritiquesBody):
+    id: Annotated[str, AfterValidator(vd.str_empty)] | None = None
+    query: Annotated[str, AfterValidator(vd.str_empty)]
+    situation: str | None = None
+    tags: list[str] | None = None
+
+
+async def iter_lines(
+    stream: AsyncIterator[bytes], max_bytes: int
+) -> AsyncIterator[bytes | None]:
+    """
+    Split a byte stream into lines without buffering more than `max_bytes`
+    of any one line. Lines over the limit are skipped and yield `None`.
+    """
+    buffer = b""
+    skipping = False
+    async for chunk in stream:
+        buffer += chunk
+        # Scan from an offset, slicing the rest off after every line would
+        # copy the chunk once per line
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line, start = buffer[start:end], end + 1
+            if skipping:
+                skipping = False
+                continue
+            yield line if len(line) <= max_bytes else None
+        buffer = buffer[start:]
+        if not skipping and len(buffer) > max_bytes:
+            skipping = True
+            yield None
+        if skipping:
+            buffer = b""
+    if buffer and not skipping:
+        yield buffer if len(buffer) <= max_bytes else None
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    Streaming response whose body iterator is still reading the request.
+    `StreamingResponse` listens for a disconnect on `receive` at the same
+    time, which would swallow request body chunks.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+@router.post("/import")
+@ahandle_error
+async def import_critiques(
+    request: Request,
+    query: Annotated[PostCritiquesImportQuery, Depends(PostCritiquesImportQuery)],
+    x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
+    tags: Annotated[list[str] | None, Query()] = None,
+) -> DuplexStreamingResponse:
+    """
+    Import critiques from a JSONL request body, one critique per line, e.g.
+    the output of `/critiques/export`. Rows are validated as they arrive and
+    upserted in batches of `IMPORT_BATCH_SIZE`, so memory stays bounded by a
+    batch. Situations are not generated, rows keep the one they carry.
+
+    The response streams JSONL events: an `error` for every rejected line or
+    failed batch, a `replaced` for every line overwritten by a later line with
+    the same id, a `progress` after every batch and a final `done`.
+    """
+    logging.info(f"import_critiques: x_critino_key: {x_critino_key} - params: {query}")
+
+    query.team_name = urllib.parse.unquote(query.team_name).strip()
+    query.environment_name = urllib.parse.unquote(query.environment_name).strip()
+
+    auth.authenticate_team_or_environment(
+        supabase, query.team_name, query.environment_name, x_critino_key
+    )
+
+    try:
+        (
+            supabase.table("environments")
+            .upsert(
+                {
+                    "team_name": query.team_name,
+                    "parent_name": query.environment_name.rsplit("/", 1)[0].strip(),
+                    "name": query.environment_name,
+                }
+            )
+            .execute()
+        )
+    except PostgrestAPIError as e:
+        logging.error(f"PostgrestAPIError: {e}")
+        raise HTTPException(status_code=500, detail={**e.json()})
+
+    def event(type: str, **data: Any) -> str:
+        return json.dumps({"type": type, **data}) + "\n"
+
+    async def write(batch: dict[str, tuple[int, dict]]) -> str | None:
+        """Upsert a batch, returning an `error` event if it failed."""
+        rows = [row for _, row in batch.values()]
+        try:
+            written = await asyncio.to_thread(
+                lambda: supabase.table("critiques").upsert(rows).execute().data
+            )
+        except Exception as e:
+            logging.error(f"import_critiques: batch of {len(rows)} failed: {e}")
+            detail = e.json() if isinstance(e, PostgrestAPIError) else str(e)
+            return event(
+                "error", lines=[line for line, _ in batch.values()], detail=detail
+            )
+
+        await few_shot.model.run(
+            few_shot.update_indexes,
+            query.team_name,
+            query.environment_name,
+            {critique["id"]: strip_critique(critique) for critique in written},
+            {critique["id"]: critique["tags"] for critique in written},
+        )
+        return None
+
+    async def events() -> AsyncIterator[str]:
+        # Keyed by id, a repeated id in one batch would fail the whole upsert
+        batch: dict[str, tuple[int, dict]] = {}
+        imported = failed = replaced = number = 0
+
+        async for line in iter_lines(request.stream(), IMPORT_MAX_LINE_BYTES):
+            number += 1
+            if line is None:
+                failed += 1
+                yield event("error", line=number, detail="Line is too long.")
+                continue
+            if not line.strip():
+                continue
+
+            try:
+                critique = ImportCritique.model_validate_json(line)
+            except ValidationError as e:
+                failed += 1
+                detail = e.errors(
+                    include_url=False, include_context=False, include_input=False
+                )
+                yield event("error", line=number, detail=detail)
+                continue
+
+            id = critique.id or str(uuid.uuid4())
+            if id in batch:
+                replaced += 1
+                yield event("replaced", line=batch[id][0], by=number, id=id)
+            batch[id] = (
+                number,
+                {
+                    **critique.model_dump(exclude={"id", "tags"}),
+                    "id": id,
+                    "team_name": query.team_name,
+                    "environment_name": query.environment_name,
+                    "tags": critique.tags if critique.tags is not None else tags or [],
+                    "response": critique.response or "",
+                    "context": critique.context or "",
+                    "optimal": critique.optimal or "",
+                    "instructions": critique.instructions or "",
+                    "situation": critique.situation or "",
+                },
+            )
+            if len(batch) < IMPORT_BATCH_SIZE:
+                continue
+
+            error = await write(batch)
+            if error is None:
+                imported += len(batch)
+            else:
+                failed += len(batch)
+                yield error
+            batch = {}
+            yield event(
+                "progress",
+                lines=number,
+                imported=imported,
+                failed=failed,
+                replaced=replaced,
+            )
+
+        if batch:
+            error = await write(batch)
+            if error is None:
+                imported += len(batch)
+            else:
+                failed += len(batch)
+                yield error
+
+        logging.info(
+            f"import_critiques: imported {imported}, failed {failed}, replaced {replaced}"
+        )
+        yield event(
+            "done",
+            lines=number,
+            imported=imported,
+            failed=failed,
+            replaced=replaced,
+        )
+
+    return DuplexStreamingResponse(events(), media_type="application/x-ndjson")
+
+
 @router.post("/{id}")
 @ahandle_error
 async def upsert(
@@ -386,6 +956,7 @@ async def upsert(
     query: Annotated[PostCritiquesQuery, Depends(PostCritiquesQuery)],
     x_critino_key: Annotated[str, Header()],
     x_openrouter_api_key: Annotated[str | None, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
     tags: Annotated[list[str] | None, Query()] = None,
 ) -> PostCritiquesResponse:
     logging.info(
@@ -400,15 +971,7 @@ async def upsert(
     if body.optimal is None:
         body.optimal = ""
 
-    model = (
-        llm.chat_open_router(
-            model="anthropic/claude-3-5-haiku-20241022:beta",
-            api_key=x_openrouter_api_key,
-            temperature=0.1,
-        )
-        if x_openrouter_api_key
-        else None
-    )
+    model = chat_model(x_openrouter_api_key)
 
     if body.optimal == "" and body.instructions == "" and query.populate_missing:
         raise HTTPException(
@@ -421,9 +984,18 @@ async def upsert(
             detail="'populate_missing' is true but no model is available to populate the fields.",
         )
 
-    filled_body = generate_fields(query, body, model) if model else None
-
-    supabase = db.client()
+    try:
+        filled_body = (
+            await llm.run_limited(
+                query.team_name, lambda: agenerate_fields(query, body, model)
+            )
+            if model
+            else None
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504, detail="Timed out generating the critique's fields."
+        )
 
     auth.authenticate_team_or_environment(
         supabase, query.team_name, query.environment_name, x_critino_key
@@ -462,6 +1034,14 @@ async def upsert(
         logging.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail={**e.__dict__})
 
+    await few_shot.model.run(
+        few_shot.update_indexes,
+        query.team_name,
+        query.environment_name,
+        {id: strip_critique(critique)},
+        {id: critique["tags"]},
+    )
+
     return PostCritiquesResponse(
         url=f"{get_url()}{sluggify(query.team_name)}/{sluggify(query.environment_name)}/critiques",
         data=critique,
@@ -472,6 +1052,10 @@ class PostManyCritique(PostCritiquesBody):
     id: Annotated[str, AfterValidator(vd.str_empty)] | None = None
 
 
+class PostManyCritiquesQuery(PostCritiquesQuery):
+    background: bool = False
+
+
 class PostManyCritiquesBody(BaseModel):
     critiques: list[PostManyCritique]
 
@@ -481,39 +1065,148 @@ class PostManyCritiquesResponse(BaseModel):
     data: list[dict]
 
 
+class PostCritiquesJobResponse(BaseModel):
+    job_id: str
+    events_url: str
+
+
+async def write_critiques(
+    supabase: Client,
+    query: PostCritiquesQuery,
+    critiques: list[PostManyCritique],
+    tags: list[str] | None,
+    model: ChatOpenAI | None,
+    on_progress: Callable[[int, int], None] | None = None,
+) -> list[dict]:
+    """
+    Generate the critiques' fields, then write them in chunked upserts and
+    apply them to the warm indexes. `on_progress` is called with the number
+    of critiques generated so far and the total.
+    """
+    generated = 0
+
+    async def fill(critique: PostManyCritique) -> FilledBody | None:
+        nonlocal generated
+        if model is None:
+            return None
+        try:
+            return await llm.run_limited(
+                query.team_name, lambda: agenerate_fields(query, critique, model)
+            )
+        except Exception as e:
+            # One slow or failing generation should not sink the batch
+            logging.error(f"upsert_many: writing critique without fields: {e!r}")
+            return None
+        finally:
+            generated += 1
+            if on_progress is not None:
+                on_progress(generated, len(critiques))
+
+    filled_critiques = await asyncio.gather(*(fill(critique) for critique in critiques))
+
+    # Keyed by id, a repeated id in one upsert would fail the whole chunk
+    rows: dict[str, dict] = {}
+    for critique, filled_critique in zip(critiques, filled_critiques):
+        id = critique.id if critique.id else str(uuid.uuid4())
+        # Every row carries every column: postgrest-py writes a key missing
+        # from any row of the chunk as NULL, and the columns are NOT NULL
+        source = filled_critique or critique
+        rows[id] = {
+            "id": id,
+            "team_name": query.team_name,
+            "environment_name": query.environment_name,
+            "tags": tags if tags else [],
+            "query": source.query or "",
+            "response": source.response or "",
+            "context": source.context or "",
+            "optimal": source.optimal or "",
+            "instructions": source.instructions or "",
+            "situation": filled_critique.situation if filled_critique else "",
+        }
+
+    # Embed for the warm indexes ahead of the write, applying the written
+    # rows afterwards then only reads the embedding cache
+    await few_shot.model.run(
+        few_shot.embed_critiques,
+        query.team_name,
+        query.environment_name,
+        [strip_critique(row) for row in rows.values()],
+    )
+
+    def write() -> list[dict]:
+        (
+            supabase.table("environments")
+            .upsert(
+                {
+                    "team_name": query.team_name,
+                    "parent_name": query.environment_name.rsplit("/", 1)[0].strip(),
+                    "name": query.environment_name,
+                }
+            )
+            .execute()
+        )
+        data = []
+        chunk = list(rows.values())
+        for start in range(0, len(chunk), UPSERT_BATCH_SIZE):
+            data += (
+                supabase.table("critiques")
+                .upsert(chunk[start : start + UPSERT_BATCH_SIZE])
+                .execute()
+                .data
+            )
+        return data
+
+    try:
+        data = await asyncio.to_thread(write)
+    except PostgrestAPIError as e:
+        logging.error(f"PostgrestAPIError: {e}")
+        raise HTTPException(status_code=500, detail={**e.json()})
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        raise HTTPException(status_code=500, detail={**e.__dict__})
+
+    await few_shot.model.run(
+        few_shot.update_indexes,
+        query.team_name,
+        query.environment_name,
+        {critique["id"]: strip_critique(critique) for critique in data},
+        {critique["id"]: critique["tags"] for critique in data},
+    )
+
+    return data
+
+
 @router.post("")
 @ahandle_error
 async def upsert_many(
     body: PostManyCritiquesBody,
-    query: Annotated[PostCritiquesQuery, Depends(PostCritiquesQuery)],
+    query: Annotated[PostManyCritiquesQuery, Depends(PostManyCritiquesQuery)],
     x_critino_key: Annotated[str, Header()],
     x_openrouter_api_key: Annotated[str | None, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
+    response: Response,
     tags: Annotated[list[str] | None, Query()] = None,
-) -> PostManyCritiquesResponse:
+) -> PostManyCritiquesResponse | PostCritiquesJobResponse:
+    """
+    With `background`, answer 202 right away with a job whose progress
+    streams from `/jobs/{id}/events`, and generate and write the critiques
+    off the request path.
+    """
     logging.info(
-        f"upsert: id: {id}, body: {body}, query: {query}, x_critino_key: {x_critino_key}, x_openrouter_api_key: {x_openrouter_api_key}"
+        f"upsert_many: body: {body}, query: {query}, x_critino_key: {x_critino_key}, x_openrouter_api_key: {x_openrouter_api_key}"
     )
     query.team_name = urllib.parse.unquote(query.team_name).strip()
     query.environment_name = urllib.parse.unquote(query.environment_name).strip()
     query.populate_missing = False
 
-    data = []
+    model = chat_model(x_openrouter_api_key)
+
     for critique in body.critiques:
         if critique.instructions is None:
             critique.instructions = ""
         if critique.optimal is None:
             critique.optimal = ""
 
-        model = (
-            llm.chat_open_router(
-                model="anthropic/claude-3-5-haiku-20241022:beta",
-                api_key=x_openrouter_api_key,
-                temperature=0.1,
-            )
-            if x_openrouter_api_key
-            else None
-        )
-
         if (
             critique.optimal == ""
             and critique.instructions == ""
@@ -523,60 +1216,70 @@ async def upsert_many(
                 status_code=400,
                 detail="both 'optimal' and 'instructions' cannot be empty when 'populate_missing' is true.",
             )
-        if query.populate_missing and model is None:
-            raise HTTPException(
-                status_code=400,
-                detail="'populate_missing' is true but no model is available to populate the fields.",
-            )
-
-        filled_critique = generate_fields(query, critique, model) if model else None
+    if query.populate_missing and model is None:
+        raise HTTPException(
+            status_code=400,
+            detail="'populate_missing' is true but no model is available to populate the fields.",
+        )
 
-        supabase = db.client()
+    auth.authenticate_team_or_environment(
+        supabase, query.team_name, query.environment_name, x_critino_key
+    )
 
-        auth.authenticate_team_or_environment(
-            supabase, query.team_name, query.environment_name, x_critino_key
+    if query.background:
+        # Ids are fixed before the job is queued, so a requeued job rewrites
+        # the same rows rather than duplicating them
+        for critique in body.critiques:
+            if not critique.id:
+                critique.id = str(uuid.uuid4())
+        job = await asyncio.to_thread(
+            jobs.queue.submit,
+            "upsert_critiques",
+            query.team_name,
+            query.environment_name,
+            {
+                "query": query.model_dump(),
+                "critiques": [critique.model_dump() for critique in body.critiques],
+                "tags": tags,
+            },
+            secrets=(
+                {"openrouter_api_key": x_openrouter_api_key}
+                if x_openrouter_api_key
+                else None
+            ),
+        )
+        response.status_code = 202
+        return PostCritiquesJobResponse(
+            job_id=job.id, events_url=f"/jobs/{job.id}/events"
         )
 
-        try:
-            (
-                supabase.table("environments")
-                .upsert(
-                    {
-                        "team_name": query.team_name.strip(),
-                        "parent_name": query.environment_name.rsplit("/", 1)[0].strip(),
-                        "name": query.environment_name.strip(),
-                    }
-                )
-                .execute()
-            )
-            critique = (
-                supabase.table("critiques")
-                .upsert(
-                    {
-                        "id": critique.id if critique.id else str(uuid.uuid4()),
-                        "team_name": query.team_name.strip(),
-                        "environment_name": query.environment_name.strip(),
-                        "tags": tags if tags else [],
-                        **(
-                            filled_critique.model_dump()
-                            if filled_critique
-                            else critique.model_dump()
-                        ),
-                    }
-                )
-                .execute()
-                .data[0]
-            )
-        except PostgrestAPIError as e:
-            logging.error(f"PostgrestAPIError: {e}")
-            raise HTTPException(status_code=500, detail={**e.json()})
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            raise HTTPException(status_code=500, detail={**e.__dict__})
-
-        data.append(critique)
+    data = await write_critiques(supabase, query, body.critiques, tags, model)
 
     return PostManyCritiquesResponse(
         url=f"{get_url()}{sluggify(query.team_name)}/{sluggify(query.environment_name)}/critiques",
         data=data,
     )
+
+
+@jobs.queue.handler("upsert_critiques")
+async def run_upsert_critiques_job(job: jobs.Job, state: Any) -> None:
+    query = PostManyCritiquesQuery(**job.payload["query"])
+    critiques = PostManyCritiquesBody(critiques=job.payload["critiques"]).critiques
+
+    data = await write_critiques(
+        state.supabase,
+        query,
+        critiques,
+        job.payload["tags"],
+        chat_model(jobs.queue.secret(job.id, "openrouter_api_key")),
+        on_progress=lambda generated, total: jobs.queue.progress(
+            job.id, generated == total, generated=generated, total=total
+        ),
+    )
+
+    jobs.queue.emit(
+        job.id,
+        "written",
+        url=f"{get_url()}{sluggify(query.team_name)}/{sluggify(query.environment_name)}/critiques",
+        ids=[critique["id"] for critique in data],
+    )
@@ -6,7 +6,7 @@ from typing import Annotated
 import urllib.parse
 from pydantic import AfterValidator, BaseModel
 from src.interfaces import db
-from supabase import PostgrestAPIError
+from supabase import Client, PostgrestAPIError
 
 from fastapi import APIRouter, Depends, HTTPException, Header
 from src.lib import auth, keys
@@ -66,9 +66,8 @@ class GetEnvironmentsResponse(BaseModel):
 async def list_environments(
     query: Annotated[GetEnvironmentsQuery, Depends(GetEnvironmentsQuery)],
     x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> GetEnvironmentsResponse:
-    supabase = db.client()
-
     query.team_name = urllib.parse.unquote(query.team_name)
     # "/" is used for parent hirearchy, don't allow in the passed name
     if "/" in name:
@@ -123,9 +122,8 @@ async def create_environment(
     body: PostEnvironmentBody,
     query: Annotated[PostEnvironmentQuery, Depends(PostEnvironmentQuery)],
     x_critino_key: Annotated[Annotated[str, AfterValidator(vd.str_empty)], Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> PostEnvironmentResponse:
-    supabase = db.client()
-
     query.team_name = urllib.parse.unquote(query.team_name)
     # "/" is used for parent hirearchy, don't allow in the passed name
     if "/" in name:
@@ -196,9 +194,8 @@ async def update_environment(
     body: PatchEnvironmentBody,
     query: Annotated[PatchEnvironmentQuery, Depends(PatchEnvironmentQuery)],
     x_critino_key: Annotated[Annotated[str, AfterValidator(vd.str_empty)], Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> PatchEnvironmentResponse:
-    supabase = db.client()
-
     query.team_name = urllib.parse.unquote(query.team_name)
 
     # "/" is used for parent hirearchy, don't allow in the passed name
@@ -239,6 +236,9 @@ async def update_environment(
         logging.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail={**e.__dict__})
 
+    # The update may rename the environment or change its key
+    auth.decisions.invalidate(query.team_name, name)
+
     return PatchEnvironmentResponse(
         data=environment,
     )
@@ -260,9 +260,8 @@ async def update_environment_key(
     name: Annotated[str, AfterValidator(vd.str_empty)],
     query: Annotated[PatchEnvironmentKeyQuery, Depends(PatchEnvironmentKeyQuery)],
     x_critino_key: Annotated[Annotated[str, AfterValidator(vd.str_empty)], Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> PatchEnvironmentKeyResponse:
-    supabase = db.client()
-
     query.team_name = urllib.parse.unquote(query.team_name)
 
     # "/" is used for parent hirearchy, don't allow in the passed name
@@ -304,6 +303,8 @@ async def update_environment_key(
         logging.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail={**e.__dict__})
 
+    auth.decisions.invalidate(query.team_name, name)
+
     return PatchEnvironmentKeyResponse(
         key=key,
         data=environment,
@@ -321,9 +322,8 @@ async def delete_environment_key(
     name: Annotated[str, AfterValidator(vd.str_empty)],
     query: Annotated[PatchEnvironmentKeyQuery, Depends(PatchEnvironmentKeyQuery)],
     x_critino_key: Annotated[Annotated[str, AfterValidator(vd.str_empty)], Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> DeleteEnvironmentKeyResponse:
-    supabase = db.client()
-
     query.team_name = urllib.parse.unquote(query.team_name)
     # "/" is used for parent hirearchy, don't allow in the passed name
     if "/" in name:
@@ -360,6 +360,8 @@ async def delete_environment_key(
         logging.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail={**e.__dict__})
 
+    auth.decisions.invalidate(query.team_name, name)
+
     return DeleteEnvironmentKeyResponse(data=environment, key=None)
 
 
@@ -378,9 +380,8 @@ async def read_environment(
     name: Annotated[str, AfterValidator(vd.str_empty)],
     query: Annotated[GetEnvironmentQuery, Depends(GetEnvironmentQuery)],
     x_critino_key: Annotated[Annotated[str, AfterValidator(vd.str_empty)], Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> GetEnvironmentResponse:
-    supabase = db.client()
-
     query.team_name = urllib.parse.unquote(query.team_name)
     # "/" is used for parent hirearchy, don't allow in the passed name
     if "/" in name:
@@ -427,9 +428,8 @@ async def delete_environment(
     name: Annotated[str, AfterValidator(vd.str_empty)],
     query: Annotated[DeleteEnvironmentQuery, Depends(DeleteEnvironmentQuery)],
     x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
 ) -> None:
-    supabase = db.client()
-
     query.team_name = urllib.parse.unquote(query.team_name)
     # "/" is used for parent hirearchy, don't allow in the passed name
     if "/" in name:
@@ -460,3 +460,5 @@ async def delete_environment(
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail={**e.__dict__})
+
+    auth.decisions.invalidate(query.team_name, name)
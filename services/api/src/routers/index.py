@@ -3,7 +3,10 @@ import logging
 from functools import wraps
 
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse
+from pydantic import BaseModel
+
+from src.lib import few_shot
 
 router = APIRouter()
 
@@ -47,3 +50,28 @@ def ahandle_error(func):
 @router.get("/")
 def redirect_to_docs() -> RedirectResponse:
     return RedirectResponse(url="/docs")
+
+
+class GetHealthResponse(BaseModel):
+    status: str
+
+
+@router.get("/health")
+def read_health() -> GetHealthResponse:
+    return GetHealthResponse(status="ok")
+
+
+class GetReadyResponse(BaseModel):
+    embeddings: bool
+    detail: str | None = None
+
+
+@router.get("/ready", response_model=GetReadyResponse)
+def read_ready() -> JSONResponse:
+    ready = GetReadyResponse(
+        embeddings=few_shot.model.ready,
+        detail=str(few_shot.model.error) if few_shot.model.error else None,
+    )
+    return JSONResponse(
+        status_code=200 if ready.embeddings else 503, content=ready.model_dump()
+    )
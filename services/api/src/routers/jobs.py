@@ -0,0 +1,64 @@
+import json
+from typing import Annotated, AsyncIterator
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
+from supabase import Client
+
+from src.interfaces import db
+from src.lib import auth, jobs
+
+router = APIRouter(prefix="/jobs")
+
+
+class GetJobResponse(BaseModel):
+    id: str
+    kind: str
+    team_name: str
+    environment_name: str
+    status: jobs.JobStatus
+    created_at: float
+    finished_at: float | None
+    events: list[jobs.JobEvent]
+
+
+def get_authorized_job(id: str, supabase: Client, key: str) -> jobs.Job:
+    job = jobs.queue.get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    auth.authenticate_team_or_environment(
+        supabase, job.team_name, job.environment_name, key
+    )
+    return job
+
+
+@router.get("/{id}")
+def read_job(
+    id: str,
+    x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
+) -> GetJobResponse:
+    job = get_authorized_job(id, supabase, x_critino_key)
+    return GetJobResponse(
+        **job.model_dump(exclude={"payload", "pid"}), events=jobs.queue.log(id)
+    )
+
+
+@router.get("/{id}/events")
+def stream_job_events(
+    id: str,
+    x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
+) -> EventSourceResponse:
+    """
+    Server-sent events of the job, from the start: `status` changes,
+    `progress` and the job's results. The stream ends when the job does.
+    """
+    get_authorized_job(id, supabase, x_critino_key)
+
+    async def events() -> AsyncIterator[dict[str, str]]:
+        async for event in jobs.queue.events(id):
+            yield {"event": event.event, "data": json.dumps(event.data)}
+
+    return EventSourceResponse(events())
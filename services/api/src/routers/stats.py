@@ -0,0 +1,43 @@
+import urllib.parse
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, Query
+from pydantic import AfterValidator, BaseModel
+from supabase import Client
+
+from src.interfaces import db
+from src.lib import auth, few_shot
+from src.lib import validators as vd
+from src.lib.cache import CacheStats, TieredCacheStats, situations
+from src.lib.embeddings import BatcherStats
+
+router = APIRouter(prefix="/stats")
+
+
+class GetStatsResponse(BaseModel):
+    embedding_cache: CacheStats
+    embedding_batcher: BatcherStats
+    indexes: list[few_shot.IndexStats]
+    situation_cache: TieredCacheStats
+
+
+@router.get("")
+def read_stats(
+    team_name: Annotated[str, Query(), AfterValidator(vd.str_empty)],
+    x_critino_key: Annotated[str, Header()],
+    supabase: Annotated[Client, Depends(db.get_client)],
+) -> GetStatsResponse:
+    """
+    Stats of the process, with the warm indexes of the team the key belongs
+    to: the names of other teams and environments are not given out.
+    """
+    team_name = urllib.parse.unquote(team_name).strip()
+    auth.authenticate_team(supabase, team_name, x_critino_key)
+    return GetStatsResponse(
+        embedding_cache=few_shot.embeddings.stats(),
+        embedding_batcher=few_shot.batcher.stats(),
+        indexes=[
+            stats for stats in few_shot.index_stats() if stats.team_name == team_name
+        ],
+        situation_cache=situations.stats(),
+    )
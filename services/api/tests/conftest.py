@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# Settings are read when `src` is imported: the in-memory database, no model
+# download, and caches that start empty
+os.environ.setdefault("CRITINO_DB", "memory")
+os.environ.setdefault("CRITINO_WARM_EMBEDDINGS", "false")
+os.environ.setdefault("CRITINO_CACHE_DIR", tempfile.mkdtemp(prefix="critino-tests-"))
+# Still above PostgREST's `max_rows`, so crossing it needs paged reads
+os.environ.setdefault("CRITINO_ANN_THRESHOLD", "2000")
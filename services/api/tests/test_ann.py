@@ -0,0 +1,8 @@
+import asyncio
+
+from benchmarks import ann
+
+
+def test_search_past_threshold_is_approximate() -> None:
+    # ANN_THRESHOLD + 1 critiques, lowered in conftest to keep this quick
+    assert asyncio.run(ann.check(None, seed=0))
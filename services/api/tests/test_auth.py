@@ -0,0 +1,153 @@
+import time
+from typing import Any, cast
+
+import pytest
+from fastapi import HTTPException
+from supabase import Client, PostgrestAPIError
+
+from src.interfaces.memory_db import MemoryClient, Row, api_error
+from src.lib import auth, keys
+
+
+@pytest.fixture
+def supabase(monkeypatch: pytest.MonkeyPatch) -> MemoryClient:
+    monkeypatch.setattr(auth, "rpc_available", True)
+    client = MemoryClient()
+    client.seed(
+        {
+            "teams": [{"name": "acme", "key": keys.encrypt_key("team-key")}],
+            "environments": [
+                {"team_name": "acme", "name": "a", "key": keys.encrypt_key("a-key")},
+                {"team_name": "acme", "name": "a/b", "key": None},
+                {"team_name": "other", "name": "a", "key": keys.encrypt_key("x")},
+            ],
+        }
+    )
+    return client
+
+
+def fetch_keys(supabase: MemoryClient, environment_names: list[str]) -> list[str]:
+    found = auth.fetch_keys(cast(Client, supabase), "acme", environment_names)
+    return sorted(key for key in found if key is not None)
+
+
+def test_fetch_keys_calls_the_function(supabase: MemoryClient) -> None:
+    calls = []
+    function = supabase.functions["auth_keys"]
+
+    def auth_keys(**params: Any) -> list[Row]:
+        calls.append(params)
+        return function(**params)
+
+    supabase.functions["auth_keys"] = auth_keys
+
+    found = fetch_keys(supabase, auth.environment_prefixes("a/b"))
+
+    assert calls == [{"team_name": "acme", "environment_names": ["a", "a/b"]}]
+    assert found == sorted([keys.encrypt_key("team-key"), keys.encrypt_key("a-key")])
+    assert auth.rpc_available
+
+
+def test_fetch_keys_falls_back_to_tables(supabase: MemoryClient) -> None:
+    expected = fetch_keys(supabase, ["a"])
+    del supabase.functions["auth_keys"]
+
+    assert fetch_keys(supabase, ["a"]) == expected
+    assert not auth.rpc_available
+    # Later calls go straight to the tables
+    assert fetch_keys(supabase, ["a"]) == expected
+
+
+def test_fetch_keys_raises_other_errors(supabase: MemoryClient) -> None:
+    def auth_keys(**params: Any) -> list[Row]:
+        raise api_error("42501", "permission denied for function auth_keys")
+
+    supabase.functions["auth_keys"] = auth_keys
+
+    with pytest.raises(PostgrestAPIError):
+        fetch_keys(supabase, [])
+    assert auth.rpc_available
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_decisions_expire(clock: Clock) -> None:
+    decisions = auth.DecisionCache(ttl=10, negative_ttl=2, max_items=100)
+    decisions.set("acme", "a", "allowed", True)
+    decisions.set("acme", "a", "denied", False)
+
+    assert decisions.get("acme", "a", "allowed") is True
+    assert decisions.get("acme", "a", "denied") is False
+    clock.now += 5
+    assert decisions.get("acme", "a", "allowed") is True
+    assert decisions.get("acme", "a", "denied") is None
+    clock.now += 5
+    assert decisions.get("acme", "a", "allowed") is None
+
+
+def test_decisions_without_ttl_are_not_kept() -> None:
+    decisions = auth.DecisionCache(ttl=0, negative_ttl=0, max_items=100)
+    decisions.set("acme", None, "crypt", True)
+    decisions.set("acme", None, "other", False)
+
+    assert decisions.get("acme", None, "crypt") is None
+    assert decisions.get("acme", None, "other") is None
+
+
+def test_decisions_are_bounded() -> None:
+    decisions = auth.DecisionCache(ttl=10, negative_ttl=10, max_items=2)
+    for crypt in ["first", "second", "third"]:
+        decisions.set("acme", None, crypt, True)
+
+    assert decisions.get("acme", None, "first") is None
+    assert decisions.get("acme", None, "third") is True
+
+
+def test_invalidate_covers_descendants() -> None:
+    decisions = auth.DecisionCache(ttl=10, negative_ttl=10, max_items=100)
+    entries = [
+        ("acme", None),
+        ("acme", "a"),
+        ("acme", "a/b"),
+        ("acme", "ab"),
+        ("other", "a"),
+    ]
+    for team_name, environment_name in entries:
+        decisions.set(team_name, environment_name, "crypt", True)
+
+    decisions.invalidate("acme", "a")
+    assert [
+        entry for entry in entries if decisions.get(*entry, "crypt") is not None
+    ] == [("acme", None), ("acme", "ab"), ("other", "a")]
+
+    decisions.invalidate("acme")
+    assert [
+        entry for entry in entries if decisions.get(*entry, "crypt") is not None
+    ] == [("other", "a")]
+
+
+def test_authenticate_caches_the_decision(supabase: MemoryClient) -> None:
+    client = cast(Client, supabase)
+    auth.decisions.invalidate("acme")
+    auth.authenticate_team_or_environment(client, "acme", "a/b", "a-key")
+    # Served from the cache, the database no longer has the key
+    supabase.table("environments").update({"key": None}).eq("name", "a").execute()
+    auth.authenticate_team_or_environment(client, "acme", "a/b", "a-key")
+
+    auth.decisions.invalidate("acme", "a")
+    with pytest.raises(HTTPException) as error:
+        auth.authenticate_team_or_environment(client, "acme", "a/b", "a-key")
+    assert error.value.status_code == 401
@@ -0,0 +1,85 @@
+import asyncio
+from typing import Any, AsyncIterator, cast
+
+import pytest
+from supabase import Client
+
+from src.interfaces.memory_db import MemoryClient
+from src.routers import critiques
+
+
+def seed(supabase: MemoryClient, size: int) -> list[str]:
+    """
+    Seed `size` critiques, in pairs sharing `created_at` with ids descending,
+    and return their ids in keyset order.
+    """
+    rows: list[dict[str, Any]] = [
+        {
+            "id": f"{size - i:05}",
+            "team_name": "acme",
+            "environment_name": "env",
+            "created_at": f"2024-01-01T00:00:{i // 2:02}+00:00",
+            "tags": ["even"] if i % 2 == 0 else [],
+        }
+        for i in range(size)
+    ]
+    supabase.seed({"critiques": rows})
+    return [
+        row["id"]
+        for row in sorted(rows, key=lambda row: (row["created_at"], row["id"]))
+    ]
+
+
+@pytest.mark.parametrize("size", [0, 7, 10, 25])
+def test_iter_critiques_pages_past_max_rows(size: int) -> None:
+    supabase = MemoryClient(max_rows=10)
+    ids = seed(supabase, size)
+
+    rows = critiques.iter_critiques(
+        cast(Client, supabase), "acme", ["env"], "id,created_at", page_size=10
+    )
+
+    assert [row["id"] for row in rows] == ids
+
+
+def test_iter_critiques_filters_tags() -> None:
+    supabase = MemoryClient(max_rows=10)
+    seed(supabase, 25)
+
+    rows = list(
+        critiques.iter_critiques(
+            cast(Client, supabase),
+            "acme",
+            ["env"],
+            "id,created_at,tags",
+            ["even"],
+            page_size=5,
+        )
+    )
+
+    assert len(rows) == 13
+    assert all(row["tags"] == ["even"] for row in rows)
+
+
+def lines(chunks: list[bytes], max_bytes: int) -> list[bytes | None]:
+    async def stream() -> AsyncIterator[bytes]:
+        for chunk in chunks:
+            yield chunk
+
+    async def collect() -> list[bytes | None]:
+        return [line async for line in critiques.iter_lines(stream(), max_bytes)]
+
+    return asyncio.run(collect())
+
+
+def test_iter_lines_joins_chunks() -> None:
+    assert lines([b"ab\nc", b"d\n\ne", b"f"], 10) == [b"ab", b"cd", b"", b"ef"]
+    assert lines([b"ab\n"], 10) == [b"ab"]
+    assert lines([], 10) == []
+
+
+def test_iter_lines_skips_long_lines() -> None:
+    # Too long within a chunk, across chunks, and at the end of the stream
+    assert lines([b"abcdef\nab\n"], 4) == [None, b"ab"]
+    assert lines([b"ab", b"cdef", b"gh\nij\n"], 4) == [None, b"ij"]
+    assert lines([b"ab\nabcdef"], 4) == [b"ab", None]
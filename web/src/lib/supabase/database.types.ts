@@ -156,7 +156,16 @@ export type Database = {
       [_ in never]: never
     }
     Functions: {
-      [_ in never]: never
+      auth_keys: {
+        Args: {
+          team_name: string
+          environment_names?: string[]
+        }
+        Returns: {
+          environment_name: string | null
+          key: string | null
+        }[]
+      }
     }
     Enums: {
       [_ in never]: never
@@ -0,0 +1,20 @@
+-- Keys that can authorize a request against a team or one of its
+-- environments, fetched in a single round trip. The row with a null
+-- environment_name is the team's own key.
+create or replace function public.auth_keys(
+    team_name text,
+    environment_names text[] default '{}'
+)
+returns table (environment_name text, key text)
+language sql
+stable
+as $$
+    select null::text, teams.key
+    from public.teams
+    where teams.name = auth_keys.team_name
+    union all
+    select environments.name, environments.key
+    from public.environments
+    where environments.team_name = auth_keys.team_name
+        and environments.name = any(auth_keys.environment_names)
+$$;
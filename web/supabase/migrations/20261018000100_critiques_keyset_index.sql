@@ -0,0 +1,4 @@
+-- Serves paged critique listings of an environment, ordered by
+-- (created_at, id), without sorting the environment on every page.
+create index if not exists critiques_environment_keyset_idx
+    on public.critiques (team_name, environment_name, created_at, id);